@@ -3,10 +3,18 @@ import shutil
 import os
 import stat
 import platform
+import signal
+import sys
+import threading
+import time
 
+from subprocess import Popen
+from magi.util import database
 from magi.util.execl import run, execAndRead
 from magi.util.agent import SharedServer, agentmethod
 from magi.util.processAgent import initializeProcessAgent
+from traffic_common import write_payload
+from traffic_stats import stats
 
 log = logging.getLogger(__name__)
 
@@ -25,6 +33,20 @@ class ApacheAgent(SharedServer):
     def __init__(self):
         SharedServer.__init__(self)
 
+        # 'apache' serves traffic_gen via Apache and mod_wsgi. 'standalone' runs
+        # traffic_server.py instead, leaving the system Apache unconfigured.
+        self.server_mode = 'apache'
+        self.port = 80
+        self.processes = 1      # standalone event loop processes.
+        self._server = None
+        self._configured = False
+
+        # if greater than 0, push the servers' request and byte counters to the
+        # database this often (in seconds).
+        self.stats_interval = 0
+        self._stats_thread = None
+        self._stats_stop = threading.Event()
+
         # supported platforms are constrained.
         # may work on others, but would not want
         # to rely on that.
@@ -36,10 +58,20 @@ class ApacheAgent(SharedServer):
         if not 12 <= maj <= 16:
             raise ApacheAgentException('Unsupported Ubuntu Version: {}'.format(maj))
 
-        self.configure()
         self.terminateserver()
 
     def runserver(self):
+        # start each run with fresh counters.
+        stats.reset()
+        self._startstats()
+
+        if self.server_mode == 'standalone':
+            return self._runstandalone()
+
+        if not self._configured:
+            self.configure()
+            self._configured = True
+
         cmd = 'sudo service apache2 restart'
         log.info('Running cmd: {}'.format(cmd))
         o, e = execAndRead(cmd, close_fds=True)
@@ -49,10 +81,92 @@ class ApacheAgent(SharedServer):
         return True
 
     def terminateserver(self):
+        self._stopstats()
+        self._stopservers()
+        return True
+
+    def _stopservers(self):
+        '''Stop the standalone server and Apache, leaving the stats thread running.'''
+        if self._server:
+            # the server may have forked workers, so signal its whole process group.
+            try:
+                os.killpg(self._server.pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+            self._server.wait()
+            self._server = None
+            log.info('Standalone traffic server stopped.')
+
         run("sudo service apache2 stop", close_fds=True)
         log.info('Apache stopped.')
+
+    def _runstandalone(self):
+        # Apache (or an earlier standalone server) may be holding the port.
+        self._stopservers()
+
+        cmd = [sys.executable,
+               os.path.join(os.path.dirname(os.path.abspath(__file__)), 'traffic_server.py'),
+               '--port', str(self.port), '--processes', str(self.processes)]
+        log.info('Running cmd: {}'.format(' '.join(cmd)))
+        self._server = Popen(cmd, close_fds=True, preexec_fn=os.setsid)
+        log.info('Standalone traffic server started.')
         return True
 
+    def _startstats(self):
+        if float(self.stats_interval) <= 0 or self._stats_thread:
+            return
+
+        self._stats_stop.clear()
+        self._stats_thread = threading.Thread(target=self._pushstats, args=(float(self.stats_interval),))
+        self._stats_thread.daemon = True
+        self._stats_thread.start()
+
+    def _stopstats(self):
+        if self._stats_thread:
+            self._stats_stop.set()
+            self._stats_thread.join()
+            self._stats_thread = None
+
+    def _pushstats(self, interval):
+        '''
+            Every interval, insert a document per (client, endpoint) that was
+            served, with the rates over the interval and the running totals.
+        '''
+        collection = database.getCollection(self.name)
+        last, last_time = {}, time.time()
+        while not self._stats_stop.wait(interval):
+            counters, overflow = stats.snapshot()
+            now = time.time()
+            elapsed, last_time = now - last_time, now
+            docs = []
+            for c in counters:
+                key = (c['client'], c['endpoint'])
+                prev = last.get(key, {'requests': 0, 'bytes': 0, 'ttfb_count': 0, 'ttfb_total': 0.0})
+                last[key] = c
+                if c['requests'] == prev['requests'] and c['bytes'] == prev['bytes'] and not c['active']:
+                    continue
+
+                ttfb_count = c['ttfb_count'] - prev['ttfb_count']
+                docs.append({
+                    'client': c['client'],
+                    'endpoint': c['endpoint'],
+                    'requests': c['requests'],
+                    'bytes': c['bytes'],
+                    'active': c['active'],
+                    'request_rate': (c['requests'] - prev['requests']) / elapsed,
+                    'byte_rate': (c['bytes'] - prev['bytes']) / elapsed,
+                    'ttfb': (c['ttfb_total'] - prev['ttfb_total']) / ttfb_count if ttfb_count else 0.0,
+                    'ttfb_max': c['ttfb_max'],
+                    'overflow': overflow,
+                })
+
+            if docs:
+                try:
+                    collection.insert(docs)
+                except Exception as e:
+                    log.error('Unable to insert server stats: {}'.format(e))
+
     def configure(self):
         # create and enable our site.
         cwd = os.path.dirname(__file__)
@@ -74,12 +188,15 @@ class ApacheAgent(SharedServer):
         except OSError:
             os.mkdir(sitedir)
 
-        for f in ['traffic_gen.py', 'traffic_gen.wsgi']:
+        for f in ['traffic_gen.py', 'traffic_common.py', 'traffic_stats.py', 'traffic_gen.wsgi']:
             shutil.copyfile(os.path.join(cwd, f), os.path.join(sitedir, f))
         
         # the script must be executable by apache
         os.chmod(os.path.join(sitedir, 'traffic_gen.py'), 0755)
 
+        # the text served is sent from this file when possible.
+        write_payload(os.path.join(sitedir, 'payload.txt'))
+
 if __name__ == '__main__':
     from sys import argv
     agent = ApacheAgent()
@@ -0,0 +1,127 @@
+'''
+What the traffic generator servers serve. Shared by the WSGI application
+(traffic_gen.py) and the standalone server (traffic_server.py).
+'''
+import os
+import threading
+import time
+
+from string import letters
+
+usage = '''
+Supported URLs:
+  /gettext/<number> - returns that many ascii bytes. Supports HTTP Range requests.
+  /gethost - returns HTML document displaying client names.
+'''
+
+# The text we serve is letters repeated, so the byte at any offset is known and
+# any range of it can be served from any copy of it. textbuf is a large chunk of
+# it which is yielded as is (without copying) for the bulk of a response.
+chunk_size = 1 << 20
+textbuf = letters * (chunk_size / len(letters))
+
+# The same text in a file, so that mod_wsgi can sendfile() it via wsgi.file_wrapper
+# rather than pushing every chunk through python. Written by the ApacheAgent.
+payload_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'payload.txt')
+payload_size = 64 * len(textbuf)
+
+def write_payload(path=payload_path):
+    if os.path.exists(path) and os.path.getsize(path) == payload_size:
+        return
+
+    with open(path, 'w') as fd:
+        for _ in xrange(payload_size / len(textbuf)):
+            fd.write(textbuf)
+
+def text_offset(start):
+    '''Where in textbuf the text at offset start of a response is.'''
+    return start % len(letters)
+
+def generate_text(start, length):
+    # first align to textbuf, then whole textbufs, then what is left.
+    offset = text_offset(start)
+    if offset:
+        head = textbuf[offset:offset+min(length, len(textbuf)-offset)]
+        length -= len(head)
+        yield head
+
+    for _ in xrange(length/len(textbuf)):
+        yield textbuf
+
+    if length % len(textbuf):
+        yield textbuf[0:length%len(textbuf)]
+
+class HostNames(object):
+    '''
+        The names for each address in a hosts file. The file is parsed once into
+        an address --> names map and only read again when its mtime changes,
+        which is checked at most every check_period seconds. The /gethost HTML
+        for each address is cached and dropped whenever the file is reloaded.
+    '''
+    def __init__(self, path='/etc/hosts', check_period=1.0, max_cached=1024):
+        self.path = path
+        self.check_period = check_period
+        self.max_cached = max_cached
+        self._names = {}
+        self._html = {}
+        self._mtime = None
+        self._checked = 0
+        self._lock = threading.Lock()
+
+    def _load(self):
+        names = {}
+        with open(self.path, 'r') as fd:
+            for l in fd:
+                fields = l.split('#', 1)[0].split()
+                if len(fields) > 1:
+                    # the first entry for an address wins, as with the old scan.
+                    names.setdefault(fields[0], fields[1:])
+
+        return names
+
+    def _refresh(self):
+        now = time.time()
+        if now - self._checked < self.check_period:
+            return
+
+        self._checked = now
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            mtime = None
+
+        if mtime == self._mtime:
+            return
+
+        try:
+            names = self._load() if mtime is not None else {}
+        except IOError:
+            names = {}
+
+        self._names, self._html, self._mtime = names, {}, mtime
+
+    def names(self, addr):
+        with self._lock:
+            self._refresh()
+            return self._names.get(addr, ['UNKNOWN'])
+
+    def html(self, addr):
+        with self._lock:
+            self._refresh()
+            html = self._html.get(addr)
+            if html is None:
+                names = self._names.get(addr, ['UNKNOWN'])
+                html = '<html><body><p>\n'
+                html += 'Source is node named {} with IP {}\n'.format(', '.join(names), addr)
+                html += '</p></body></html>\n'
+                if len(self._html) >= self.max_cached:
+                    self._html.clear()
+
+                self._html[addr] = html
+
+            return html
+
+hosts = HostNames()
+
+def gethost_html(addr):
+    return hosts.html(addr)
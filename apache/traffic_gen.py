@@ -1,67 +1,81 @@
-from string import letters
+import json
+import os
+import time
+
 from flask import Flask, Response, request
+from werkzeug.wsgi import wrap_file
+from traffic_common import usage, chunk_size, payload_path, payload_size, generate_text, gethost_html
+from traffic_stats import stats, CountedStream, CountedFile
 
 app = Flask(__name__)
 
 @app.route('/')
 def index():
-    msg = '''
-Supported URLs:
-  /gettext/<number> - returns that many ascii bytes.
-  /gethost - returns HTML document displaying client names.
-'''
-    return Response(msg, 200)
+    return Response(usage, 200)
 
 @app.route('/gettext/<size>')
 def gettext_size(size):
-    return gettext(size)
+    return gettext(size, 'gettext')
 
 @app.route('/getsize.py', methods=['get'])
 def getsize_py():
     size = int(request.args.get('length'))
-    return gettext(size)
-
-textbuf = letters * 64 # don't really know a good size for this.
-def gettext(size):
-    global textbuf
+    return gettext(size, 'getsize')
 
+def gettext(size, endpoint):
     try:
         size = int(size)
     except ValueError:
         return Response('Bad size: {}'.format(size))
 
-    def generate_text():
-        for _ in xrange(size/len(textbuf)):
-            yield textbuf
+    status = 200
+    start, length = 0, size
+    if request.range:
+        range_ = request.range.range_for_length(size)
+        if not range_:
+            resp = Response('Requested range not satisfiable', 416)
+            resp.headers.add('Content-Range', 'bytes */{}'.format(size))
+            return resp
+
+        status = 206
+        start, length = range_[0], range_[1]-range_[0]
+
+    client = request.remote_addr
+    begun = stats.begin(client, endpoint)
+
+    # only mod_wsgi is known to stop a wrapped file at the Content-Length.
+    if 'mod_wsgi.version' in request.environ and start+length <= payload_size \
+            and os.path.exists(payload_path):
+        fd = open(payload_path, 'rb')
+        fd.seek(start)
+        body = wrap_file(request.environ, CountedFile(fd, client, endpoint, begun, length), chunk_size)
+    else:
+        body = CountedStream(generate_text(start, length), client, endpoint, begun)
+
+    resp = Response(body, status, mimetype='text/plain', direct_passthrough=True)
+    resp.headers.add('Content-Length', str(length))
+    resp.headers.add('Accept-Ranges', 'bytes')
+    if status == 206:
+        resp.headers.add('Content-Range', 'bytes {}-{}/{}'.format(start, start+length-1, size))
 
-        yield textbuf[0:size%len(textbuf)]
-    
-    resp = Response(generate_text(), mimetype='text/plain')
-    resp.headers.add('Content-Length', str(size))
     return resp
 
 @app.route('/gethost')
 def gethost():
-    addr = request.remote_addr
-    names = []
-    with open('/etc/hosts', 'r') as fd:
-        for l in fd.readlines():
-            if l.startswith(addr):
-                names = l.split()[1:]
-                break
-        else:
-            names = ['UNKNOWN']
-
-    ret = '<html><body><p>\n'
-    ret += 'Source is node named {} with IP {}\n'.format(', '.join(names), addr)
-    ret += '</p></body></html>\n'
-
-    return Response(ret)
+    begun = stats.begin(request.remote_addr, 'gethost')
+    html = gethost_html(request.remote_addr)
+    stats.finish(request.remote_addr, 'gethost', len(html), time.time() - begun)
+    return Response(html)
 
 @app.route('/gethost.py')   # backwards compat.
 def gethost_py():
     return gethost()
 
+@app.route('/stats')
+def server_stats():
+    counters, overflow = stats.snapshot()
+    return Response(json.dumps({'stats': counters, 'overflow': overflow}), mimetype='application/json')
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0')
 
@@ -0,0 +1,360 @@
+#!/usr/bin/env python
+'''
+A standalone HTTP/1.1 server for the traffic generator URLs (see traffic_gen.py).
+
+Each process runs a single threaded epoll loop, so a process holds as many
+(slow) connections as it has file descriptors. Text is streamed straight out of
+the shared textbuf via memoryview, so large responses are not copied. With
+--processes N, N-1 workers are forked and accept from the same listening socket.
+'''
+import argparse
+import errno
+import json
+import logging
+import os
+import select
+import signal
+import socket
+import sys
+import time
+
+from urlparse import urlsplit, parse_qs
+
+from traffic_common import usage, textbuf, text_offset, gethost_html
+from traffic_stats import stats
+
+log = logging.getLogger(__name__)
+
+max_request = 16384         # longest request head we accept.
+send_size = 256 * 1024      # most text sent to one connection per wakeup, so no one hogs the loop.
+
+responses = {
+    200: 'OK',
+    206: 'Partial Content',
+    400: 'Bad Request',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    416: 'Requested Range Not Satisfiable',
+}
+
+def parse_range(header, size):
+    '''
+        Parse a single range "bytes=first-[last]" or "bytes=-suffix" Range header.
+        Returns (start, length), None if the range can not be satisfied, or
+        False if it is not a range we understand, in which case it is ignored.
+    '''
+    unit, _, spec = header.partition('=')
+    if unit.strip() != 'bytes' or ',' in spec or '-' not in spec:
+        return False
+
+    first, _, last = spec.strip().partition('-')
+    try:
+        if not first:
+            suffix = int(last)
+            if suffix <= 0:
+                return None
+
+            start, stop = max(size-suffix, 0), size
+        else:
+            start = int(first)
+            stop = min(int(last)+1, size) if last else size
+    except ValueError:
+        return False
+
+    if start >= size or stop <= start:
+        return None
+
+    return start, stop-start
+
+class Connection(object):
+    '''One client connection: buffered request bytes in, a response (head and text stream) out.'''
+    def __init__(self, sock, addr):
+        self.sock = sock
+        self.addr = addr[0]
+        self.inbuf = ''
+        self.outbuf = ''
+        self.text_at = 0        # offset in textbuf of the next text to send.
+        self.text_left = 0      # text still to send for this response.
+        self.keep_alive = True
+        self.closed = False
+        self.stream = None      # [endpoint, start, sent, ttfb] of the text being sent, for the stats.
+
+    def busy(self):
+        return bool(self.outbuf or self.text_left > 0)
+
+    def on_read(self):
+        try:
+            data = self.sock.recv(65536)
+        except socket.error as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                self.closed = True
+            return
+
+        if not data:
+            self.closed = True
+            return
+
+        self.inbuf += data
+        self.handle_requests()
+
+    def on_write(self):
+        try:
+            if self.outbuf:
+                sent = self.sock.send(self.outbuf)
+                self.outbuf = self.outbuf[sent:]
+                if self.outbuf:
+                    return
+
+            if self.text_left > 0:
+                n = min(self.text_left, len(textbuf)-self.text_at, send_size)
+                sent = self.sock.send(memoryview(textbuf)[self.text_at:self.text_at+n])
+                if self.stream[3] is None:
+                    self.stream[3] = time.time() - self.stream[1]
+
+                self.stream[2] += sent
+                self.text_left -= sent
+                # textbuf holds whole repeats of the text, so wrapping keeps it continuous.
+                self.text_at = (self.text_at+sent) % len(textbuf)
+        except socket.error as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                self.closed = True
+            return
+
+        if not self.busy():
+            self.end_stream()
+            if not self.keep_alive:
+                self.closed = True
+            else:
+                self.handle_requests()   # any pipelined requests.
+
+    def handle_requests(self):
+        while not self.busy() and not self.closed:
+            end = self.inbuf.find('\r\n\r\n')
+            if end < 0:
+                if len(self.inbuf) > max_request:
+                    self.respond(400, 'Request too long\n', close=True)
+                return
+
+            head, self.inbuf = self.inbuf[:end], self.inbuf[end+4:]
+            self.handle_request(head)
+
+    def handle_request(self, head):
+        lines = head.split('\r\n')
+        try:
+            method, target, version = lines[0].split()
+        except ValueError:
+            self.respond(400, 'Bad request line\n', close=True)
+            return
+
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        connection = headers.get('connection', '').lower()
+        if version == 'HTTP/1.0':
+            self.keep_alive = connection == 'keep-alive'
+        else:
+            self.keep_alive = connection != 'close'
+
+        if method not in ('GET', 'HEAD'):
+            self.respond(405, 'Only GET and HEAD are supported\n')
+            return
+
+        url = urlsplit(target)
+        path = url.path
+        size = None
+        if path.startswith('/gettext/'):
+            size = path[len('/gettext/'):]
+        elif path == '/getsize.py':
+            size = parse_qs(url.query).get('length', [None])[0]
+        elif path in ('/gethost', '/gethost.py'):
+            begun = stats.begin(self.addr, 'gethost')
+            html = gethost_html(self.addr)
+            stats.finish(self.addr, 'gethost', len(html), time.time() - begun)
+            self.respond(200, html, 'text/html', head_only=method == 'HEAD')
+            return
+        elif path == '/stats':
+            counters, overflow = stats.snapshot()
+            self.respond(200, json.dumps({'stats': counters, 'overflow': overflow}), 'application/json',
+                         head_only=method == 'HEAD')
+            return
+        elif path == '/':
+            self.respond(200, usage, head_only=method == 'HEAD')
+            return
+        else:
+            self.respond(404, 'Not found\n')
+            return
+
+        try:
+            size = int(size)
+            if size < 0:
+                raise ValueError(size)
+        except (TypeError, ValueError):
+            self.respond(400, 'Bad size: {}\n'.format(size))
+            return
+
+        endpoint = 'gettext' if path.startswith('/gettext/') else 'getsize'
+        self.stream = [endpoint, stats.begin(self.addr, endpoint), 0, None]
+        self.send_text(size, headers.get('range'), method == 'HEAD')
+        if self.text_left <= 0:
+            self.end_stream()
+
+    def end_stream(self):
+        if self.stream:
+            endpoint, start, sent, ttfb = self.stream
+            stats.finish(self.addr, endpoint, sent, ttfb if ttfb is not None else time.time() - start)
+            self.stream = None
+
+    def send_text(self, size, range_header, head_only):
+        status, start, length = 200, 0, size
+        extra = ['Accept-Ranges: bytes']
+        if range_header:
+            range_ = parse_range(range_header, size)
+            if range_ is None:
+                self.respond(416, '', extra=['Content-Range: bytes */{}'.format(size)])
+                return
+
+            if range_:
+                status, (start, length) = 206, range_
+                extra.append('Content-Range: bytes {}-{}/{}'.format(start, start+length-1, size))
+
+        self.outbuf += self.head(status, length, 'text/plain', extra)
+        if not head_only and length > 0:
+            self.text_at = text_offset(start)
+            self.text_left = length
+
+    def respond(self, status, body, content_type='text/plain', extra=[], close=False, head_only=False):
+        if close:
+            self.keep_alive = False
+
+        self.outbuf += self.head(status, len(body), content_type, extra)
+        if not head_only:
+            self.outbuf += body
+
+    def head(self, status, length, content_type, extra):
+        lines = ['HTTP/1.1 {} {}'.format(status, responses[status]),
+                 'Content-Type: {}'.format(content_type),
+                 'Content-Length: {}'.format(length)]
+        if not self.keep_alive:
+            lines.append('Connection: close')
+
+        return '\r\n'.join(lines + extra) + '\r\n\r\n'
+
+    def close(self):
+        self.end_stream()
+        try:
+            self.sock.close()
+        except socket.error:
+            pass
+
+class TrafficServer(object):
+    def __init__(self, host='0.0.0.0', port=80, processes=1, backlog=4096):
+        self.host = host
+        self.port = port
+        self.processes = processes
+        self.backlog = backlog
+        self._running = True
+        self._children = []
+
+    def serve(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind((self.host, self.port))
+        listener.listen(self.backlog)
+        listener.setblocking(0)
+
+        for _ in range(self.processes-1):
+            pid = os.fork()
+            if pid == 0:
+                self._children = []
+                signal.signal(signal.SIGTERM, self._stop)
+                self._loop(listener)
+                os._exit(0)
+
+            self._children.append(pid)
+
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        try:
+            self._loop(listener)
+        finally:
+            for pid in self._children:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                    os.waitpid(pid, 0)
+                except OSError:
+                    pass
+
+            listener.close()
+
+    def _stop(self, signum, frame):
+        self._running = False
+
+    def _loop(self, listener):
+        ep = select.epoll()
+        ep.register(listener.fileno(), select.EPOLLIN)
+        conns = {}
+        while self._running:
+            try:
+                events = ep.poll(1.0)
+            except IOError as e:    # interrupted by a signal.
+                if e.errno != errno.EINTR:
+                    raise
+                continue
+
+            for fd, event in events:
+                if fd == listener.fileno():
+                    self._accept(listener, ep, conns)
+                    continue
+
+                conn = conns.get(fd)
+                if not conn:
+                    continue
+
+                if event & (select.EPOLLHUP | select.EPOLLERR):
+                    conn.closed = True
+                else:
+                    if event & select.EPOLLIN:
+                        conn.on_read()
+                    if event & select.EPOLLOUT and not conn.closed:
+                        conn.on_write()
+
+                if conn.closed:
+                    ep.unregister(fd)
+                    conn.close()
+                    del conns[fd]
+                else:
+                    # only read new requests once the current response is sent.
+                    ep.modify(fd, select.EPOLLOUT if conn.busy() else select.EPOLLIN)
+
+        for conn in conns.values():
+            conn.close()
+
+        ep.close()
+
+    def _accept(self, listener, ep, conns):
+        while True:
+            try:
+                sock, addr = listener.accept()
+            except socket.error as e:
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ECONNABORTED):
+                    log.error('accept failed: {}'.format(e))
+                return
+
+            sock.setblocking(0)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            conns[sock.fileno()] = Connection(sock, addr)
+            ep.register(sock.fileno(), select.EPOLLIN)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Standalone traffic generator HTTP server.')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=80)
+    parser.add_argument('--processes', type=int, default=1,
+                        help='number of processes (each with its own event loop) to serve from.')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    TrafficServer(args.host, args.port, args.processes).serve()
+    sys.exit(0)
@@ -0,0 +1,217 @@
+'''
+Per client, per endpoint counters of what the traffic generator servers serve:
+requests, bytes, active streams and time to first byte. The counters live in a
+small memory mapped file (on tmpfs) so every WSGI process and every standalone
+server process adds to the same table, and the ApacheAgent can read it directly.
+'''
+import fcntl
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+log = logging.getLogger(__name__)
+
+stats_path = '/dev/shm/traffic_gen_stats'
+
+# header: magic, number of slots, number of (client, endpoint) pairs that did not fit.
+_header = struct.Struct('=8sIxxxxQ')
+_magic = 'TGSTATS1'
+_header_size = 64
+
+# a slot: client, endpoint, requests, bytes, active, ttfb count, ttfb total (us), ttfb max (us).
+_slot = struct.Struct('=48s16sQQqQQQ')
+
+class ServerStats(object):
+    '''
+        An open addressed hash table of counters in a shared memory mapped file.
+        Updates take a file lock (processes) and a thread lock (threads within a
+        process), so they are exact across processes. The file is opened on
+        first use; if it can not be, the counters are quietly not kept.
+    '''
+    def __init__(self, path=stats_path, slots=4096):
+        self.path = path
+        self.slots = slots
+        self._fd = None
+        self._map = None
+        self._failed = False
+        self._lock = threading.Lock()
+
+    def _open(self):
+        if self._map is not None or self._failed:
+            return self._map is not None
+
+        try:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0666)
+            try:
+                os.fchmod(fd, 0666)     # writable by whoever the web server runs as.
+            except OSError:
+                pass
+
+            fcntl.lockf(fd, fcntl.LOCK_EX)
+            try:
+                if os.fstat(fd).st_size < _header_size:
+                    os.ftruncate(fd, _header_size + self.slots * _slot.size)
+                    os.write(fd, _header.pack(_magic, self.slots, 0))
+                else:
+                    magic, slots, _ = _header.unpack(os.read(fd, _header.size))
+                    if magic != _magic:
+                        raise ValueError('{} is not a traffic stats file'.format(self.path))
+
+                    self.slots = slots
+            finally:
+                fcntl.lockf(fd, fcntl.LOCK_UN)
+
+            self._map = mmap.mmap(fd, _header_size + self.slots * _slot.size)
+            self._fd = fd
+        except (OSError, IOError, ValueError) as e:
+            log.error('Not keeping traffic stats, unable to open {}: {}'.format(self.path, e))
+            self._failed = True
+
+        return self._map is not None
+
+    def _locked(self, fn, *args):
+        with self._lock:
+            if not self._open():
+                return None
+
+            fcntl.lockf(self._fd, fcntl.LOCK_EX)
+            try:
+                return fn(*args)
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN)
+
+    def _find(self, client, endpoint):
+        '''The offset of the slot for (client, endpoint), claiming one if need be. Lock held.'''
+        client, endpoint = client[:48], endpoint[:16]
+        first = zlib.crc32(client + '\0' + endpoint) % self.slots
+        for i in xrange(self.slots):
+            offset = _header_size + ((first + i) % self.slots) * _slot.size
+            c, e = _slot.unpack_from(self._map, offset)[:2]
+            c, e = c.rstrip('\0'), e.rstrip('\0')
+            if not c:
+                _slot.pack_into(self._map, offset, client, endpoint, 0, 0, 0, 0, 0, 0)
+                return offset
+
+            if c == client and e == endpoint:
+                return offset
+
+        magic, slots, overflow = _header.unpack_from(self._map, 0)
+        _header.pack_into(self._map, 0, magic, slots, overflow + 1)
+        return None
+
+    def _update(self, client, endpoint, requests, nbytes, active, ttfb):
+        offset = self._find(client, endpoint)
+        if offset is None:
+            return
+
+        c, e, r, b, a, tc, tt, tm = _slot.unpack_from(self._map, offset)
+        if ttfb is not None:
+            us = int(ttfb * 1000000)
+            tc, tt, tm = tc + 1, tt + us, max(tm, us)
+
+        _slot.pack_into(self._map, offset, c, e, r + requests, b + nbytes, a + active, tc, tt, tm)
+
+    def begin(self, client, endpoint):
+        '''A request for endpoint from client has started streaming. Returns its start time.'''
+        start = time.time()
+        self._locked(self._update, client, endpoint, 1, 0, 1, None)
+        return start
+
+    def finish(self, client, endpoint, nbytes, ttfb):
+        '''The stream started by begin() is done, after sending nbytes, the first ttfb seconds after it began.'''
+        self._locked(self._update, client, endpoint, 0, nbytes, -1, ttfb)
+
+    def _snapshot(self):
+        stats = []
+        for i in xrange(self.slots):
+            c, e, r, b, a, tc, tt, tm = _slot.unpack_from(self._map, _header_size + i * _slot.size)
+            if c.rstrip('\0'):
+                stats.append({
+                    'client': c.rstrip('\0'),
+                    'endpoint': e.rstrip('\0'),
+                    'requests': r,
+                    'bytes': b,
+                    'active': a,
+                    'ttfb_count': tc,
+                    'ttfb_total': tt / 1000000.0,
+                    'ttfb_max': tm / 1000000.0,
+                })
+
+        return stats, _header.unpack_from(self._map, 0)[2]
+
+    def snapshot(self):
+        '''A list of the counters for every (client, endpoint) seen and the number that did not fit.'''
+        return self._locked(self._snapshot) or ([], 0)
+
+    def _reset(self):
+        self._map[:] = '\0' * len(self._map)
+        _header.pack_into(self._map, 0, _magic, self.slots, 0)
+
+    def reset(self):
+        self._locked(self._reset)
+
+stats = ServerStats()
+
+class CountedStream(object):
+    '''
+        Iterates over body, recording its size and time to first byte once it
+        is closed. Closing is up to the WSGI server, which does so even if the
+        body was never iterated (HEAD requests) or the client went away.
+    '''
+    def __init__(self, body, client, endpoint, start):
+        self._body = body
+        self._client = client
+        self._endpoint = endpoint
+        self._start = start
+        self._sent = 0
+        self._ttfb = None
+        self._closed = False
+
+    def __iter__(self):
+        for chunk in self._body:
+            if self._ttfb is None:
+                self._ttfb = time.time() - self._start
+
+            self._sent += len(chunk)
+            yield chunk
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            ttfb = self._ttfb if self._ttfb is not None else time.time() - self._start
+            stats.finish(self._client, self._endpoint, self._sent, ttfb)
+
+class CountedFile(object):
+    '''
+        A file which records the stream as finished when it is closed. It still
+        has a fileno() so mod_wsgi can sendfile() it from a wsgi.file_wrapper.
+    '''
+    def __init__(self, fd, client, endpoint, start, length):
+        self._fd = fd
+        self._client = client
+        self._endpoint = endpoint
+        self._length = length
+        self._ttfb = time.time() - start    # the first byte goes out once we hand it over.
+        self._closed = False
+
+    def read(self, size=-1):
+        return self._fd.read(size)
+
+    def fileno(self):
+        return self._fd.fileno()
+
+    def seek(self, offset, whence=0):
+        return self._fd.seek(offset, whence)
+
+    def tell(self):
+        return self._fd.tell()
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self._fd.close()
+            stats.finish(self._client, self._endpoint, self._length, self._ttfb)
@@ -4,15 +4,24 @@
 # This software is licensed under the GPLv3 license, included in
 # ./GPLv3-LICENSE.txt in the source distribution
 
-from magi.util.agent import TrafficClientAgent
+from magi.util.agent import TrafficClientAgent, agentmethod
 from magi.util.processAgent import initializeProcessAgent
 from magi.util.distributions import *
 from magi.util import database
 from magi.util.execl import execAndRead
+from distribution_sampler import DistributionSampler
+from http_transport import HttpTransport
+from open_loop import OpenLoopScheduler
+from metrics_sink import MetricsSink
+from latency_histogram import LatencyHistograms
+
+import httplib
+import socket
 
 import logging
 import random
 import sys
+import threading
 
 log = logging.getLogger(__name__)
 
@@ -26,6 +35,7 @@ class CurlAgent(TrafficClientAgent):
 
         # Can be support distribution function (look magi.util.distributions)
         self.sizes = '1000'
+        self._sizes = None   # DistributionSampler for sizes.
         self.url = "http://%s/gettext/%d"
 
         # SOCKS support
@@ -34,7 +44,34 @@ class CurlAgent(TrafficClientAgent):
         self.socksPort = 5010
         self.socksVersion = 4
 
+        # "curl" forks a curl process per request. "http" fetches in process over
+        # a pool of keep-alive connections. SOCKS always uses curl.
+        self.transport = 'curl'
+
+        # If True, start requests at the times given by interval whether or not
+        # earlier requests have finished (open loop) using up to workers
+        # concurrent requests, rather than waiting for each request to finish
+        # before scheduling the next (closed loop).
+        self.open_loop = False
+        self.workers = 16
+
+        # at most this many metrics are buffered in memory waiting to be written
+        # to the database. Past that, metrics are dropped (and counted).
+        self.max_buffered_metrics = 10000
+
+        # If True, keep per server latency histograms and write a summary of
+        # them (with percentiles) to <name>_latency every second. If
+        # per_request_metrics is False, only the summaries are written.
+        self.latency_histograms = False
+        self.per_request_metrics = True
+
         self.db_configured = False
+        self._transport = None
+        self._scheduler = None
+        self._lock = threading.Lock()  # open loop workers set up _transport and _sizes concurrently.
+        self._sink = None   # batches metrics into the database.
+        self._latency_sink = None
+        self._histograms = None
 
     def _write_data_to_collection(self, output):
         # the output line is:
@@ -48,38 +85,69 @@ class CurlAgent(TrafficClientAgent):
 
         # regex might be more reliable, but slower?
         results = output.split(',')
-        self.collection.insert({
-            'server': results[0].split('/')[2],
-            'time': float(results[1]),
-            'size': float(results[3]),
-            'speed': float(results[4].strip())
+        self._write_metrics(results[0].split('/')[2], float(results[1]), float(results[2]),
+                            float(results[3]), float(results[4].strip()))
+
+    def _write_metrics(self, server, time_, start_transfer_time, size, speed):
+        if self._histograms:
+            self._histograms.record(server, {
+                'start_transfer_time': start_transfer_time,
+                'total_time': time_
+            })
+            if self._histograms.due():
+                self._histograms.publish(self._latency_sink.add)
+
+        if not self.per_request_metrics:
+            return
+
+        self._sink.add({
+            'server': server,
+            'time': time_,
+            'size': size,
+            'speed': speed
         })
 
+    def _configure_database(self):
+        self.collection = database.getCollection(self.name)
+        self.schedule_collection = database.getCollection(self.name + '_schedule')
+        self._sink = MetricsSink(self.collection, maxlen=int(self.max_buffered_metrics))
+        self._sink.start()
+
+        if self.latency_histograms:
+            self._histograms = LatencyHistograms(['start_transfer_time', 'total_time'])
+            self._latency_sink = MetricsSink(database.getCollection(self.name + '_latency'),
+                                             maxlen=int(self.max_buffered_metrics))
+            self._latency_sink.start()
+
+        # set up visualization server to show our metrics.
+        # we do this here as self.name exists here but not in __init__()
+        viz_collection = database.getCollection('viz_data')
+        for unit in ['time', 'size', 'speed']:
+            viz_collection.insert({
+                'datatype': 'horizon_chart',
+                'display': 'Http Client',
+                'table': self.name,
+                'node_key': 'host',
+                'data_key': unit})
+
+        self.db_configured = True
+
     def oneClient(self):
         """ Called when the next client should fire (after interval time) 
         We "overload" it here so we can write the results to our collection.
         """
         if not self.db_configured:
-            self.collection = database.getCollection(self.name)
-
-            # set up visualization server to show our metrics.
-            # we do this here as self.name exists here but not in __init__()
-            viz_collection = database.getCollection('viz_data')
-            for unit in ['time', 'size', 'speed']:
-                viz_collection.insert({
-                    'datatype': 'horizon_chart',
-                    'display': 'Http Client',
-                    'table': self.name,
-                    'node_key': 'host',
-                    'data_key': unit})
-
-            self.db_configured = True
+            self._configure_database()
 
         if len(self.servers) < 1:
             log.warning("no servers to contact, nothing to do")
             return
         # fp = open(self.logfile, 'a')
         dst = self.servers[random.randint(0, len(self.servers) - 1)]
+        if self.transport == 'http' and not self.useSocks:
+            self._fetch(dst)
+            return
+
         try:
             (output, err) = execAndRead(self.getCmd(dst))
             # fp.write(str(time.time()) + "\t" + output)
@@ -87,34 +155,87 @@ class CurlAgent(TrafficClientAgent):
                 self._write_data_to_collection(output)
         except OSError as e:
             log.error("can't execute command: %s", e)
-            fp.close()
+
+    def _fetch(self, dst):
+        '''Fetch from dst in process and write the same metrics curl would give us.'''
+        try:
+            metrics = self._get_transport().fetch(self.url % (dst, int(self._size_sampler().sample())))
+        except (httplib.HTTPException, socket.error) as e:
+            log.error("error fetching from %s: %s", dst, e)
+            return
+
+        if self.collection:
+            self._write_metrics(dst, metrics['time'], metrics['start_transfer_time'],
+                                metrics['size'], metrics['speed'])
+
+    @agentmethod()
+    def startClient(self, msg):
+        if not self.open_loop:
+            return TrafficClientAgent.startClient(self, msg)
+
+        if not self.db_configured:
+            self._configure_database()
+
+        self._size_sampler()
+        self._scheduler = OpenLoopScheduler(self.oneClient, DistributionSampler(self.interval),
+                                            workers=int(self.workers),
+                                            report=self.schedule_collection.insert,
+                                            abort=self._get_transport().abort)
+        self._scheduler.start()
+        return True
+
+    @agentmethod()
+    def stopClient(self, msg):
+        if self._scheduler:
+            self._scheduler.stop()
+            self._scheduler = None
+            ret = True
+        else:
+            ret = TrafficClientAgent.stopClient(self, msg)
+
+        if self._histograms:
+            self._histograms.publish(self._latency_sink.add)
+
+        for sink in [self._sink, self._latency_sink]:
+            if sink:
+                sink.flush()
+
+        return ret
 
     def getCmd(self, dst):
-        cmd = 'curl -o /dev/null -s -S -w data=%{url_effective},%{time_total},%{time_starttransfer},%{size_download},%{speed_download}\\n ' + self.url % (dst, eval(self.sizes))
+        cmd = 'curl -o /dev/null -s -S -w data=%{url_effective},%{time_total},%{time_starttransfer},%{size_download},%{speed_download}\\n ' + self.url % (dst, int(self._size_sampler().sample()))
         if self.useSocks:
             socks_cmd = "--proxy socks%d://%s:%d" % (int(self.socksVersion), self.socksServer, int(self.socksPort))
             cmd += socks_cmd
         return cmd	
         
+    def _get_transport(self):
+        with self._lock:
+            if not self._transport:
+                self._transport = HttpTransport()
+
+            return self._transport
+
+    def _size_sampler(self):
+        # rebuild the sampler only when the sizes expression is (re)configured.
+        with self._lock:
+            if not self._sizes or self._sizes.expression != str(self.sizes):
+                self._sizes = DistributionSampler(self.sizes)
+
+            return self._sizes
+
     def increaseTraffic(self, msg, stepsize):
-        self.sizes = eval(self.sizes) + stepsize
-        self.sizes = str(self.sizes)
+        self._size_sampler().adjust(stepsize)
 
     def reduceTraffic(self, msg, stepsize):
-        self.sizes = eval(self.sizes) - stepsize
-        if(self.sizes < 0):
-            self.sizes = 0
-        self.sizes = str(self.sizes)
+        self._size_sampler().adjust(-stepsize)
                
     def changeTraffic(self, msg, stepsize):
         prob = random.randint(0, 100)
         if prob in range(10):
-            self.sizes = eval(self.sizes) + int(stepsize * random.random())
+            self._size_sampler().adjust(int(stepsize * random.random()))
         elif prob in range(10, 20):
-            self.sizes = eval(self.sizes) - int(stepsize * random.random())
-            if(self.sizes < 0):
-                self.sizes = 0
-        self.sizes = str(self.sizes)
+            self._size_sampler().adjust(-int(stepsize * random.random()))
     
 def getAgent(**kwargs):
     agent = CurlAgent()
@@ -2,11 +2,13 @@
 
 import logging
 import time
+from collections import deque
 
 from magi.util.agent import ReportingDispatchAgent, agentmethod
 from magi.util.processAgent import initializeProcessAgent
 from magi.util import database
 from libdeterdash import DeterDashboard
+from reducers import Reducer, ReducerException, is_named, percentile
 
 log = logging.getLogger(__name__)
 
@@ -22,11 +24,24 @@ class DataAggregationAgent(ReportingDispatchAgent):
         # set enclaves for testing. Production should set this via AAL.
         self.enclaves = None
 
-        # A valid python expression/function. "data_list" will be the 
-        # data to aggregate (as a list) and available in the global
-        # "namespace" of the expression.
+        # A python expression. "L" will be the data to aggregate (as a list) and
+        # available in the "namespace" of the expression along with a few safe
+        # builtins and mean(), median(), p95(), percentile() and stddev().
+        # The expression is compiled once in confirmConfiguration.
         self.reduce_method = 'sum(L)/len(L)'  # average
 
+        # If set, one of "sum", "mean", "min", "max", "count" or "pNN" (a percentile,
+        # e.g. "p95"). The reduction is then done by the database in a single
+        # aggregation pipeline across all enclaves and reduce_method is ignored.
+        self.aggregation_method = None
+
+        # A list of {data_key, reducer, output_key} dicts to aggregate several keys
+        # and/or reductions from one fetch. reducer is either a named reduction as in
+        # aggregation_method or a reduce_method expression. output_key defaults to
+        # data_key. If not given, data_key and reduce_method/aggregation_method are
+        # used. If all reducers are named, the database does the reduction.
+        self.aggregations = None
+
         self.agent_key = None           # may be a single value or a list.
         self.data_key = None
         self.node_key = 'host'          # only change if your node is under a different key.
@@ -34,6 +49,14 @@ class DataAggregationAgent(ReportingDispatchAgent):
 
         self.lag = 10.0    # look 10 seconds in teh past for data.
 
+        # If True, only fetch data newer than the last data seen and keep rolling
+        # per enclave windows of data instead of re-querying the whole window each
+        # period. windows is a list of window sizes in seconds, all computed from
+        # the same scan. The first window is written under the output key, the
+        # others under <output key>_<window>s. Defaults to [aggregation_period].
+        self.incremental = False
+        self.windows = None
+
         # "private" variables. 
         self._active = False
 
@@ -44,6 +67,11 @@ class DataAggregationAgent(ReportingDispatchAgent):
             raise DataAggregationAgentException('Unable to connect to Magi database.')
         
         self._viz_configured = False
+        self._specs = []            # list of {data_key, output_key, method, reducer}
+        self._node2enclave = {}     # node --> [enclaves it is in], in incremental mode.
+        self._use_pipeline = True   # False once the database has failed to run our pipeline.
+        self._high_water = None     # newest "created" timestamp seen in incremental mode.
+        self._samples = {}          # enclave --> deque of (created, {data_key: value}) in incremental mode.
 
     def periodic(self, now):
         if not self._active:
@@ -62,9 +90,10 @@ class DataAggregationAgent(ReportingDispatchAgent):
             log.info('configuring visualization.')
             # tell the GUI we want to display this data.
             dashboard = DeterDashboard()
-            units = [{'data_key': self.data_key,
+            units = [{'data_key': spec['output_key'],
                       'display': 'Bytes',          # requires knowledge of the aggregated agent.
-                      'unit': 'bytes/sec'}]        # need to abstract this somehow...
+                      'unit': 'bytes/sec'}         # need to abstract this somehow...
+                     for spec in self._specs]
             dashboard.add_time_plot('Aggregated', self.name, 'enclave', units)
             self._viz_configured = True
 
@@ -72,8 +101,47 @@ class DataAggregationAgent(ReportingDispatchAgent):
 
         # get access to the agent's collection for reading.
         # log.debug('Checking for aggregatable data in {}/{}.'.format(self.agent_key, self.data_key))
-        log.info('Checking for aggregatable data in {}/{}.'.format(self.agent_key, self.data_key))
+        log.info('Checking for aggregatable data in {}/{}.'.format(self.agent_key, self._data_keys()))
+
+        if self.incremental:
+            agg_values = self._aggregate_incremental(now)
+        elif self._use_pipeline and all(spec['method'] for spec in self._specs):
+            agg_values = self._aggregate_pipeline(now)
+        else:
+            agg_values = self._aggregate_python(now)
+
+        for name, outputs in agg_values.iteritems():
+            # ...and insert into our collection.
+            entry = {'enclave': name}
+            entry.update(outputs)
+            self._collection.insert(entry)
+
+        # call this again after period has elapsed. 
+        ret = self.aggregation_period+now-time.time()
+        return ret if ret > 0 else 0
+
+    def _window(self, now):
+        return {'$gte': float(now-self.aggregation_period-self.lag), '$lt': float(now-self.lag)}
+
+    def _data_keys(self):
+        return sorted(set(spec['data_key'] for spec in self._specs))
+
+    def _reduce(self, spec, agg_data):
+        '''Apply the spec's reduction to the list of aggregated data.'''
+        if not agg_data:
+            return 0.0
 
+        try:
+            return spec['reducer'](agg_data)
+        except Exception as e:
+            log.error('Error evaluating aggregation method: {}'.format(e))
+
+        return 0.0
+
+    def _aggregate_python(self, now):
+        '''Fetch the data for each enclave and reduce it via the reduce expressions.'''
+        data_keys = self._data_keys()
+        agg_values = {}
         # find new data using given table and key and timestamp.
         for name, nodes in self.enclaves.iteritems():
             # log.debug('Looking for aggregatable data for enclave {} with nodes {}.'.format(name, nodes))
@@ -82,54 +150,218 @@ class DataAggregationAgent(ReportingDispatchAgent):
             args = { 
                 'agent': {'$in': self.agent_key},
                 self.node_key: {'$in': nodes},
-                'created': {'$gte': float(now-self.aggregation_period-self.lag), '$lt': float(now-self.lag)}
+                'created': self._window(now)
             }
 
-            filter_ = {
-                '_id': False,
-                self.data_key: True 
-            }
+            filter_ = {'_id': False}
+            for key in data_keys:
+                filter_[key] = True
+
             log.debug('search: {}\nfilter: {}'.format(args, filter_))
             cursor = self._db.experiment_data.find(args, filter_)
-            agg_data = []
+            agg_data = {key: [] for key in data_keys}
             for entry in cursor:
-                if self.data_key in entry:   # sometimes there is not a matching key. Dunno why.
-                    agg_data.append(entry[self.data_key])
+                for key in data_keys:
+                    if key in entry:   # sometimes there is not a matching key. Dunno why.
+                        agg_data[key].append(entry[key])
 
             log.debug('adding data to {} aggregate: {}'.format(name, agg_data))
 
-            if agg_data:
-                # apply reduction to the list of aggregated data.
-                try:
-                    agg_value = eval(self.reduce_method, {'L': agg_data})
-                except Exception as e:   # eval is dangerous
-                    log.error('Error evaluating aggregation method: {}'.format(e))
-
-                log.debug('adding aggregated value to {}'.format(name, agg_value))
-            else:
-                agg_value = 0.0
-
-            # ...and insert into our collection.
-            self._collection.insert({
-                self.data_key: agg_value,
-                'enclave': name
-            })
-
-        # call this again after period has elapsed. 
-        ret = self.aggregation_period+now-time.time()
-        return ret if ret > 0 else 0
-
+            outputs = {}
+            for spec in self._specs:
+                outputs[spec['output_key']] = self._reduce(spec, agg_data[spec['data_key']])
+
+            log.debug('adding aggregated values to {}: {}'.format(name, outputs))
+            agg_values[name] = outputs
+
+        return agg_values
+
+    def _aggregate_pipeline(self, now):
+        '''
+            Reduce the data for all enclaves in a single database aggregation
+            pipeline. The database reduces each node's data; those are then
+            combined per enclave here, so a node in several enclaves counts in
+            each, as in _aggregate_python. Only $group accumulators every
+            MongoDB version has are used. If the pipeline fails anyway, this
+            and later periods are reduced in python.
+        '''
+        all_nodes = set()
+        for nodes in self.enclaves.itervalues():
+            all_nodes.update(nodes)
+
+        # accumulators per spec. Output keys may contain dots, which $group does not allow.
+        group = {'_id': '$' + self.node_key}
+        for i, spec in enumerate(self._specs):
+            value = '$' + spec['data_key']
+            method = spec['method']
+            if method.startswith('p'):
+                group['v{}'.format(i)] = {'$push': value}   # percentiles are not a $group accumulator.
+            elif method in ('min', 'max', 'sum'):
+                group['v{}'.format(i)] = {'$' + method: value}
+
+            if method in ('mean', 'count'):
+                # only count documents which have the key.
+                group['n{}'.format(i)] = {'$sum': {'$cond': [{'$eq': [{'$ifNull': [value, None]}, None]}, 0, 1]}}
+                group['v{}'.format(i)] = {'$sum': value}
+
+        pipeline = [
+            {'$match': {
+                'agent': {'$in': self.agent_key},
+                self.node_key: {'$in': list(all_nodes)},
+                '$or': [{key: {'$exists': True}} for key in self._data_keys()],
+                'created': self._window(now)
+            }},
+            {'$group': group}
+        ]
+        log.debug('pipeline: {}'.format(pipeline))
+
+        try:
+            result = self._db.experiment_data.aggregate(pipeline)
+            # older pymongo returns the command response rather than a cursor.
+            if isinstance(result, dict):
+                result = result.get('result', [])
+
+            per_node = {entry['_id']: entry for entry in result}
+        except Exception as e:
+            log.error('Error running aggregation pipeline, reducing in python from now on: {}'.format(e))
+            self._use_pipeline = False
+            return self._aggregate_python(now)
+
+        agg_values = {}
+        for name, nodes in self.enclaves.iteritems():
+            entries = [per_node[node] for node in nodes if node in per_node]
+            outputs = {}
+            for i, spec in enumerate(self._specs):
+                method = spec['method']
+                values = [e.get('v{}'.format(i)) for e in entries]
+                counts = [e.get('n{}'.format(i), 0) for e in entries]
+                if method.startswith('p'):
+                    value = percentile([v for vs in values for v in vs or [] if v is not None], float(method[1:]))
+                elif method == 'mean':
+                    value = float(sum(v or 0 for v in values)) / sum(counts) if sum(counts) else None
+                elif method == 'count':
+                    value = sum(counts)
+                elif method == 'sum':
+                    value = sum(v or 0 for v in values)
+                else:
+                    values = [v for v in values if v is not None]
+                    value = (min if method == 'min' else max)(values) if values else None
+
+                outputs[spec['output_key']] = value if value is not None else 0.0
+
+            agg_values[name] = outputs
+
+        return agg_values
+
+    def _aggregate_incremental(self, now):
+        '''Fetch only data newer than the high water mark and reduce the rolling windows.'''
+        end = float(now-self.lag)
+        longest = max(self.windows)
+        if self._high_water is None:
+            self._high_water = end-longest
+
+        data_keys = self._data_keys()
+        args = {
+            'agent': {'$in': self.agent_key},
+            self.node_key: {'$in': self._node2enclave.keys()},
+            '$or': [{key: {'$exists': True}} for key in data_keys],
+            'created': {'$gt': self._high_water, '$lt': end}
+        }
+        filter_ = {
+            '_id': False,
+            'created': True,
+            self.node_key: True,
+        }
+        for key in data_keys:
+            filter_[key] = True
+
+        log.debug('search: {}\nfilter: {}'.format(args, filter_))
+        # sorted so each enclave's samples stay in time order across fetches.
+        for entry in self._db.experiment_data.find(args, filter_).sort('created', 1):
+            names = self._node2enclave.get(entry.get(self.node_key))
+            if not names:
+                continue
+
+            # a node in several enclaves counts in each, as in the other paths.
+            values = {key: entry[key] for key in data_keys if key in entry}
+            for name in names:
+                self._samples[name].append((entry['created'], values))
+
+            self._high_water = max(self._high_water, entry['created'])
+
+        agg_values = {}
+        for name, samples in self._samples.iteritems():
+            # drop anything older than the longest window.
+            while samples and samples[0][0] < end-longest:
+                samples.popleft()
+
+            outputs = {}
+            for i, window in enumerate(self.windows):
+                for spec in self._specs:
+                    key = spec['output_key']
+                    key = key if i == 0 else '{}_{:g}s'.format(key, window)
+                    agg_data = [v[spec['data_key']] for c, v in samples
+                                if c >= end-window and spec['data_key'] in v]
+                    outputs[key] = self._reduce(spec, agg_data)
+
+            agg_values[name] = outputs
+
+        return agg_values
 
     @agentmethod()
     def confirmConfiguration(self):
-        for key in ['enclaves', 'agent_key', 'data_key']:
+        for key in ['enclaves', 'agent_key']:
             if not getattr(self, key, None):
                 log.critical('No "{}" given in AAL. Unable to continue.'.format(key))
                 return False
 
+        if not self.aggregations and not self.data_key:
+            log.critical('No "data_key" or "aggregations" given in AAL. Unable to continue.')
+            return False
+
+        if self.aggregation_method and not is_named(self.aggregation_method):
+            log.critical('Unknown aggregation_method "{}". Unable to continue.'.format(
+                self.aggregation_method))
+            return False
+
+        aggregations = self.aggregations if self.aggregations else [{
+            'data_key': self.data_key,
+            'reducer': self.aggregation_method if self.aggregation_method else self.reduce_method
+        }]
+        self._specs = []
+        for agg in aggregations:
+            if 'data_key' not in agg or 'reducer' not in agg:
+                log.critical('Aggregation {} needs a data_key and reducer. Unable to continue.'.format(agg))
+                return False
+
+            try:
+                reducer = Reducer(agg['reducer'])
+            except ReducerException as e:
+                log.critical('Bad reducer: {}. Unable to continue.'.format(e))
+                return False
+
+            self._specs.append({
+                'data_key': agg['data_key'],
+                'output_key': agg.get('output_key', agg['data_key']),
+                'method': agg['reducer'] if is_named(agg['reducer']) else None,
+                'reducer': reducer
+            })
+
         # listify the agent key as we expect a list later.
         self.agent_key = self.agent_key if type(self.agent_key) == list else [self.agent_key]
 
+        if self.incremental:
+            self.windows = self.windows if self.windows else [self.aggregation_period]
+            self.windows = self.windows if type(self.windows) == list else [self.windows]
+            self.windows = [float(w) for w in self.windows]
+            self._node2enclave = {}
+            for name, nodes in self.enclaves.iteritems():
+                for node in nodes:
+                    self._node2enclave.setdefault(node, []).append(name)
+
+            self._samples = {name: deque() for name in self.enclaves}
+            self._high_water = None
+
         return True
 
     def startCollection(self, msg):
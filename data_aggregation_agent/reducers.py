@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+
+'''
+Compile and evaluate the reduce_method expressions used by the DataAggregationAgent.
+
+The expression is parsed once, checked against a whitelist of python syntax, and compiled
+to a code object which is then evaluated against a restricted namespace. "L" in the
+namespace is the list of data to reduce.
+'''
+
+import ast
+import logging
+import math
+
+log = logging.getLogger(__name__)
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+class ReducerException(Exception):
+    pass
+
+# python syntax allowed in a reduce_method expression. Attribute access is not allowed
+# so there is no way to get at dunder methods and escape the namespace.
+_allowed_nodes = set([
+    'Expression', 'Expr', 'Load', 'Store', 'Name', 'Num', 'Str', 'Constant', 'NameConstant',
+    'BinOp', 'UnaryOp', 'BoolOp', 'Compare', 'IfExp', 'Call', 'keyword',
+    'Subscript', 'Index', 'Slice', 'Tuple', 'List',
+    'ListComp', 'GeneratorExp', 'comprehension',
+    'Add', 'Sub', 'Mult', 'Div', 'FloorDiv', 'Mod', 'Pow', 'USub', 'UAdd', 'Not',
+    'And', 'Or', 'Eq', 'NotEq', 'Lt', 'LtE', 'Gt', 'GtE', 'In', 'NotIn'
+])
+
+def _array(data):
+    return numpy.asarray(data, dtype=float)
+
+def mean(data):
+    if not len(data):
+        return 0.0
+
+    if numpy:
+        return float(numpy.mean(_array(data)))
+
+    return float(sum(data))/len(data)
+
+def percentile(data, pct):
+    '''Return the pct-th percentile of data, linearly interpolated between ranks.'''
+    if not len(data):
+        return 0.0
+
+    if numpy:
+        return float(numpy.percentile(_array(data), pct))
+
+    data = sorted(data)
+    rank = (len(data) - 1) * pct / 100.0
+    low = int(math.floor(rank))
+    high = int(math.ceil(rank))
+    return data[low] + (data[high] - data[low]) * (rank - low)
+
+def median(data):
+    return percentile(data, 50)
+
+def p95(data):
+    return percentile(data, 95)
+
+def stddev(data):
+    if not len(data):
+        return 0.0
+
+    if numpy:
+        return float(numpy.std(_array(data)))
+
+    m = mean(data)
+    return math.sqrt(sum((x - m) ** 2 for x in data)/len(data))
+
+# What a reduce_method expression is allowed to call.
+_builtins = {
+    'sum': sum, 'len': len, 'min': min, 'max': max, 'abs': abs, 'sorted': sorted,
+    'float': float, 'int': int, 'round': round,
+    'mean': mean, 'median': median, 'p95': p95, 'percentile': percentile, 'stddev': stddev,
+}
+
+# reductions with a direct equivalent in the database aggregation pipeline. A "pNN"
+# percentile (e.g. "p95") is also a named reduction.
+_named = {
+    'sum': 'sum(L)',
+    'mean': 'mean(L)',
+    'min': 'min(L)',
+    'max': 'max(L)',
+    'count': 'len(L)',
+}
+
+def is_named(reducer):
+    '''Return True if reducer is a named reduction rather than a python expression.'''
+    if reducer in _named:
+        return True
+
+    return reducer.startswith('p') and reducer[1:].replace('.', '', 1).isdigit()
+
+def named_expression(reducer):
+    '''Return the python expression equivalent to the named reduction.'''
+    if reducer in _named:
+        return _named[reducer]
+
+    return 'percentile(L, {})'.format(float(reducer[1:]))
+
+class Reducer(object):
+    '''A reduce_method expression compiled once and evaluated many times.'''
+    def __init__(self, expression):
+        if is_named(expression):
+            expression = named_expression(expression)
+
+        self.expression = expression
+
+        try:
+            tree = ast.parse(expression, mode='eval')
+        except SyntaxError as e:
+            raise ReducerException('Unable to parse reduce method "{}": {}'.format(expression, e))
+
+        for node in ast.walk(tree):
+            name = type(node).__name__
+            if name not in _allowed_nodes:
+                raise ReducerException('"{}" not allowed in reduce method "{}"'.format(name, expression))
+
+            if name == 'Name' and node.id.startswith('__'):
+                raise ReducerException('"{}" not allowed in reduce method "{}"'.format(node.id, expression))
+
+        self._code = compile(tree, '<reduce_method>', 'eval')
+
+    def __call__(self, data):
+        namespace = dict(_builtins)
+        namespace['__builtins__'] = {}
+        namespace['L'] = data
+        return eval(self._code, namespace)
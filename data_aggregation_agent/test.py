@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import data_aggregation_agent
+
+class FakeCursor(list):
+    def sort(self, key, direction):
+        return FakeCursor(sorted(self, key=lambda e: e[key], reverse=direction < 0))
+
+class FakeCollection(object):
+    '''Just enough of a mongo collection for the queries the agent makes.'''
+    def __init__(self, docs):
+        self.docs = docs
+
+    def _matches(self, doc, args):
+        for key, cond in args.iteritems():
+            if key == '$or':
+                if not any(self._matches(doc, c) for c in cond):
+                    return False
+                continue
+
+            if not isinstance(cond, dict):
+                cond = {'$eq': cond}
+
+            for op, value in cond.iteritems():
+                if op == '$exists':
+                    if (key in doc) != value:
+                        return False
+                elif key not in doc:
+                    return False
+                elif op == '$eq' and doc[key] != value:
+                    return False
+                elif op == '$in' and doc[key] not in value:
+                    return False
+                elif op == '$gt' and not doc[key] > value:
+                    return False
+                elif op == '$gte' and not doc[key] >= value:
+                    return False
+                elif op == '$lt' and not doc[key] < value:
+                    return False
+
+        return True
+
+    def find(self, args, filter_):
+        return FakeCursor(
+            dict((k, v) for k, v in doc.iteritems() if filter_.get(k))
+            for doc in self.docs if self._matches(doc, args))
+
+class FakeDatabase(object):
+    def __init__(self, docs):
+        self.connection = {'magi': type('FakeDB', (object,), {'experiment_data': FakeCollection(docs)})()}
+
+    def getConnection(self):
+        return self.connection
+
+class OverlappingEnclavesTest(unittest.TestCase):
+    ''' A node in several enclaves is counted in each, whichever way the data is aggregated. '''
+
+    now = 1000.0
+    enclaves = {'e1': ['n1', 'n2'], 'e2': ['n2', 'n3']}
+
+    def setUp(self):
+        created = self.now - 10.5
+        docs = [
+            {'agent': 'counter', 'host': 'n1', 'created': created, 'bytes': 1},
+            {'agent': 'counter', 'host': 'n2', 'created': created, 'bytes': 10},
+            {'agent': 'counter', 'host': 'n3', 'created': created, 'bytes': 100},
+            {'agent': 'counter', 'host': 'n2', 'created': created + 0.25, 'bytes': 1000},
+            {'agent': 'other', 'host': 'n2', 'created': created, 'bytes': 10000},
+        ]
+        self._database = data_aggregation_agent.database
+        data_aggregation_agent.database = FakeDatabase(docs)
+
+    def tearDown(self):
+        data_aggregation_agent.database = self._database
+
+    def _aggregate(self, reducer, incremental):
+        agent = data_aggregation_agent.DataAggregationAgent()
+        agent.enclaves = self.enclaves
+        agent.agent_key = 'counter'
+        agent.aggregations = [{'data_key': 'bytes', 'reducer': reducer}]
+        agent.incremental = incremental
+        self.assertTrue(agent.confirmConfiguration())
+        if incremental:
+            return agent._aggregate_incremental(self.now)
+
+        return agent._aggregate_python(self.now)
+
+    def test_Incremental(self):
+        for reducer in ['len(L)', 'sum(L)', 'max(L)']:
+            expected = self._aggregate(reducer, False)
+            self.assertEqual(self._aggregate(reducer, True), expected)
+
+        self.assertEqual(self._aggregate('len(L)', True), {'e1': {'bytes': 3}, 'e2': {'bytes': 3}})
+        self.assertEqual(self._aggregate('sum(L)', True), {'e1': {'bytes': 1011}, 'e2': {'bytes': 1110}})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -11,21 +11,19 @@ from magi.util.agent import agentmethod, ReportingDispatchAgent
 from magi.util.processAgent import initializeProcessAgent
 #from runtimeStatsCollector import getRuntimeStatsCollector, PlatformNotSupportedException
 from libdeterdash import DeterDashboard
+from log_tailer import LogTailer
+from stream_stats import StreamStats, stream_name
+from stats_socket import StatsSocket
 
 import logging
 import os
+import socket
 import sys
 import time
 import random
 
 log = logging.getLogger(__name__)
 
-class FileInfo(object):
-    # Not many of these, so no need for defining __slots__ directly.
-    file_name = ''
-    last_report_time = -1
-    fd = None
-
 class GstreamerRTPAgentViz(ReportingDispatchAgent):
     """
         Since gstreamer tools are separate, individually runnable tools we cannot integrate
@@ -42,7 +40,15 @@ class GstreamerRTPAgentViz(ReportingDispatchAgent):
         self.dir_to_check = None
         # We ignore files older than watch_range minutes.
         self.watch_range = 15
-        self._watched_files = {}
+        # We stop watching (and close) files not written to for idle_timeout seconds.
+        self.idle_timeout = 60
+        # A stream is stalled while its FPS is below stall_fps.
+        self.stall_fps = 1.0
+        # If given, also take stats records (see stats_socket.py) sent to a UNIX datagram socket at this path.
+        self.stats_socket = None
+        self._tailer = None
+        self._socket = None
+        self._stats = None
         self._db_configured = False
         self._loglevel = 'info' 
 
@@ -50,76 +56,69 @@ class GstreamerRTPAgentViz(ReportingDispatchAgent):
         if self.active:
             if not self._db_configured:
                 self._configure_database()
+            if not self._stats:
+                self._start_collecting()
             #log.info("Calling progress metric.")
-            self._check_files()
+            if self.dir_to_check:
+                self._check_files()
+            self._report()
         #else:
         #    log.info("Not reporting.")
 
-        next_now = now + int(self.interval) - time.time()
+        next_now = now + float(self.interval) - time.time()
         if next_now > 0:
             return next_now
         else:
             return 0
             
+    def _start_collecting(self):
+        # silent streams are kept (as stalled) as long as the tailer keeps their files.
+        self._stats = StreamStats(float(self.stall_fps), max(2 * float(self.interval), 1.0),
+                                  float(self.idle_timeout))
+        if self.stats_socket:
+            # Records are added as they arrive, so they are in the very next report.
+            self._socket = StatsSocket(self.stats_socket, self._stats.add)
+            try:
+                self._socket.start()
+            except (OSError, IOError, socket.error) as e:
+                log.error("Unable to receive stats on %s: %s" % (self.stats_socket, e))
+                self._socket = None
+
+    def _stop_collecting(self):
+        if self._socket:
+            self._socket.stop()
+            self._socket = None
+        if self._tailer:
+            self._tailer.close()
+            self._tailer = None
+        self._stats = None
+
     def _check_files(self):
         if not self.active:
             return
-        now = int(time.time())
-        newlines = []
-        fpses = []
-        # See if any new files showed up that we should watch.
-        for file in [f for f in os.listdir(self.dir_to_check) if os.path.isfile(os.path.join(self.dir_to_check, f))]:
-            mt_time = int(os.path.getmtime(os.path.join(self.dir_to_check, file)))
-            # If this file's been modified in the last self.watch_range, we should check this file.
-            if mt_time + (self.watch_range * 60) >= now and file not in self._watched_files:
-            #if file not in self._watched_files:
-                fi = FileInfo()
-                try:
-                    fi.fd = open(os.path.join(self.dir_to_check, file), 'r')
-                    # Jump to the end of the file.
-                    fi.fd.seek(0, 2)
-                    fi.file_name = file
-                    self._watched_files[file] = fi
-                    log.info("Added %s to list of watched files." % file)
-                except Exception as e:
-                    log.warn("Problem reading from %s/%s: %s" % (self.dir_to_check,f, e))
-                    del fi
-                    pass
-                    
-        log.info("Watching %d files." % (len(self._watched_files)))
-        x=0
-        try:
-            for file in self._watched_files:
-                x=x+1
-                #log.info("Watching %s" % self._watched_files[file].file_name)
-                if self._watched_files[file].fd != None:
-                    #log.info("Have opened %s" % self._watched_files[file].file_name)
-                    try:
-                        line = None
-                        line = self._watched_files[file].fd.readline()
-                        if line:
-                            newlines.append(line)
-                    except Exception as e:
-                        log.warn("Problem reading from %s. Could not get last new line:%s" % (self._watched_files[file], e))
-                        pass
-        except Exception as e:
-            log.error("%s" % e)
-            raise e
-        for line in newlines:
-            if 'FPS:' in line:
+        if not self._tailer:
+            # Files already there are read from their end, as we only report what happens from now.
+            self._tailer = LogTailer(self.dir_to_check, self.watch_range * 60, self.idle_timeout)
+
+        newlines = self._tailer.poll()
+        log.info("Watching %d files." % self._tailer.watched())
+
+        for file, lines in newlines.iteritems():
+            for line in lines:
                 try:
-                    fps = line.split('FPS:')[-1].split()[0]
-                    fpses.append(int(fps))
+                    self._stats.add_line(stream_name(file), line)
                 except Exception as e:
                     log.warn("Problem extracting stats from %s. Could not parse line. :%s" % (line, e))
-                    pass  
-        if len(fpses) > 0:
-            avgfps = float(sum(fpses))/float(len(fpses))
-            log.info("Avg FPS is: %.02f" % avgfps)
-            self._save_metrics(avgfps)
+
+    def _report(self):
+        doc = self._stats.document()
+        if doc:
+            log.info("%d streams, min/p10/median FPS: %s/%s/%s" % (
+                len(doc['streams']), doc.get('fps_min'), doc.get('fps_p10'), doc.get('fps_median')))
+            self._save_metrics(doc)
         else:
             log.info("No stats to report.")
-                    
+
     def _configure_database(self):
         log.info("Configuring database with name \"%s\"." % self.name)
         self._collection = database.getCollection(self.name)
@@ -130,13 +129,26 @@ class GstreamerRTPAgentViz(ReportingDispatchAgent):
             {'data_key': 'frame_rate', 'display':'Frames per Second', 'unit':'frames'},
         ]
         dashboard.add_time_plot('RTP Agent', self.name, 'host', units)
+        # How the streams are spread, so the worst ones do not hide in the average.
+        units = [
+            {'data_key': 'fps_min', 'display':'Min Stream FPS', 'unit':'frames'},
+            {'data_key': 'fps_p10', 'display':'10th Percentile Stream FPS', 'unit':'frames'},
+            {'data_key': 'fps_median', 'display':'Median Stream FPS', 'unit':'frames'},
+        ]
+        dashboard.add_time_plot('RTP Stream FPS', self.name, 'host', units)
+        units = [
+            {'data_key': 'jitter_median', 'display':'Median Stream Jitter', 'unit':'ms'},
+            {'data_key': 'jitter_max', 'display':'Max Stream Jitter', 'unit':'ms'},
+            {'data_key': 'drops_total', 'display':'Dropped Frames', 'unit':'frames'},
+            {'data_key': 'stalled_streams', 'display':'Stalled Streams', 'unit':'streams'},
+        ]
+        dashboard.add_time_plot('RTP Stream Quality', self.name, 'host', units)
         self._db_configured = True
         log.info("Configured database.")
     
-    def _save_metrics(self, avgfps):
-        self._collection.insert({
-            'frame_rate': avgfps,
-        })
+    def _save_metrics(self, doc):
+        # One document per interval, the per stream values in arrays ordered as doc['streams'].
+        self._collection.insert(doc)
         log.info("Saving progress stats")
 
     @agentmethod()
@@ -146,17 +158,19 @@ class GstreamerRTPAgentViz(ReportingDispatchAgent):
 
     def stopReporting(self, msg):
         self.active = False
+        self._stop_collecting()
         return True
 
     def confirmConfiguration(self):
         log.info('Checking given configuration...')
-        if self.dir_to_check == None:
-            log.critical('Not given directory to watch and find data.')
+        if self.dir_to_check == None and not self.stats_socket:
+            log.critical('Not given directory to watch or socket to find data.')
             return False
         try:
-            self.interval= int(self.interval)
+            # Less than a second is fine, stats records are in the next report as soon as they arrive.
+            self.interval= float(self.interval)
         except ValueError:
-            log.error('Not given reporting interval in integer seconds: %s', self.interval)
+            log.error('Not given reporting interval in seconds: %s', self.interval)
             return False
         return True
         
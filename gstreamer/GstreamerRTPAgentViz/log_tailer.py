@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import struct
+import time
+
+log = logging.getLogger(__name__)
+
+# from sys/inotify.h
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+_event = struct.Struct('iIII')  # wd, mask, cookie, len
+
+class _Inotify(object):
+    '''Just enough of inotify (via libc) to learn which files in one directory changed.'''
+    def __init__(self, path):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+        mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+        if libc.inotify_add_watch(self._fd, path, mask) < 0:
+            err = ctypes.get_errno()
+            os.close(self._fd)
+            raise OSError(err, 'inotify_add_watch {} failed'.format(path))
+
+    def changed(self):
+        '''
+            The names of the files changed since the last call, or None if
+            events were lost and everything should be checked.
+        '''
+        names = set()
+        while True:
+            try:
+                buf = os.read(self._fd, 65536)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return names
+                raise
+
+            offset = 0
+            while offset < len(buf):
+                wd, mask, cookie, length = _event.unpack_from(buf, offset)
+                offset += _event.size
+                if mask & IN_Q_OVERFLOW:
+                    names = None
+                elif names is not None and length:
+                    names.add(buf[offset:offset+length].rstrip('\0'))
+
+                offset += length
+
+    def close(self):
+        os.close(self._fd)
+
+class _Tailed(object):
+    '''A file being tailed: its open file, where we are in it and any partial last line.'''
+    def __init__(self, fd, offset):
+        self.fd = fd
+        self.offset = offset
+        self.partial = ''
+        self.last_change = time.time()
+
+class LogTailer(object):
+    '''
+        Tail every log file in a directory. poll() returns all the complete lines
+        written to each file since the last poll, however many there are.
+
+        Files are kept open while they change and closed (evicted) once they
+        have not changed for idle_timeout seconds. An evicted file that changes
+        again is picked up from where it was left. Files present when tailing
+        starts are read from their size then; files that show up later from
+        their start. A file that shrinks (is truncated) is read from its start
+        again. Files not modified for watch_range seconds are ignored until
+        they are.
+
+        inotify tells us which files changed. Where it is not available, the
+        directory is listed each poll and files are checked by size.
+    '''
+    def __init__(self, directory, watch_range=15*60, idle_timeout=60):
+        self.directory = directory
+        self.watch_range = watch_range
+        self.idle_timeout = idle_timeout
+        self._files = {}        # name --> _Tailed, open files.
+        self._offsets = {}      # name --> offset, for files known but not open.
+        self._partials = {}     # name --> partial last line, for evicted files.
+        try:
+            self._inotify = _Inotify(directory)
+        except (OSError, AttributeError) as e:     # AttributeError: no inotify in libc.
+            log.info('inotify not available ({}), checking files by size.'.format(e))
+            self._inotify = None
+
+        self._scan(initial=True)
+
+    def _scan(self, initial=False):
+        '''
+            Look for files in the directory we are not tailing. Returns the names
+            of the ones opened. In the initial scan, every file is known from its
+            current size, so only what is written from now on is read.
+        '''
+        now = time.time()
+        new = []
+        for name in os.listdir(self.directory):
+            if name in self._files:
+                continue
+
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+
+            if not os.path.isfile(path):
+                continue
+
+            if initial:
+                self._offsets[name] = st.st_size
+
+            if st.st_mtime + self.watch_range < now:
+                continue
+
+            # a file we do not know of is new since we started.
+            offset = self._offsets.get(name, 0)
+            if st.st_size < offset:
+                log.info('{} was truncated, reading it from the start.'.format(name))
+                offset = 0
+            elif name in self._offsets and st.st_size == offset and not initial:
+                continue    # not changed since we last read it.
+
+            if self._open(name, offset):
+                new.append(name)
+
+        return new
+
+    def _open(self, name, offset):
+        try:
+            fd = open(os.path.join(self.directory, name), 'r')
+            fd.seek(offset)
+        except (IOError, OSError) as e:
+            log.warn('Problem reading from {}/{}: {}'.format(self.directory, name, e))
+            return False
+
+        self._offsets.pop(name, None)
+        partial = self._partials.pop(name, '')
+        self._files[name] = _Tailed(fd, offset)
+        if offset:
+            self._files[name].partial = partial
+        log.info('Added {} to list of watched files.'.format(name))
+        return True
+
+    def _evict(self, name):
+        tailed = self._files.pop(name)
+        tailed.fd.close()
+        self._offsets[name] = tailed.offset
+        if tailed.partial:
+            self._partials[name] = tailed.partial
+        log.info('{} unchanged for {}s, no longer watching it.'.format(name, self.idle_timeout))
+
+    def _read(self, name):
+        '''All the complete new lines in name.'''
+        tailed = self._files[name]
+        try:
+            if os.fstat(tailed.fd.fileno()).st_size < tailed.offset:
+                log.info('{} was truncated, reading it from the start.'.format(name))
+                tailed.fd.seek(0)
+                tailed.offset = 0
+                tailed.partial = ''
+
+            data = tailed.fd.read()
+        except (IOError, OSError) as e:
+            log.warn('Problem reading from {}: {}'.format(name, e))
+            return []
+
+        if not data:
+            return []
+
+        tailed.offset += len(data)
+        tailed.last_change = time.time()
+        lines = (tailed.partial + data).split('\n')
+        tailed.partial = lines.pop()
+        return lines
+
+    def poll(self):
+        '''Returns {name: [new lines]} for the files with new lines.'''
+        if self._inotify:
+            changed = self._inotify.changed()
+            if changed is None:
+                self._scan()
+                changed = set(self._files)
+            else:
+                # open changed files we are not tailing: new or evicted ones.
+                if [n for n in changed if n not in self._files]:
+                    self._scan()
+
+                changed = set(n for n in changed if n in self._files)
+        else:
+            self._scan()
+            changed = set()
+            for name, tailed in self._files.iteritems():
+                try:
+                    if os.fstat(tailed.fd.fileno()).st_size != tailed.offset:
+                        changed.add(name)
+                except OSError:
+                    pass
+
+        lines = {}
+        for name in changed:
+            new = self._read(name)
+            if new:
+                lines[name] = new
+
+        now = time.time()
+        for name in [n for n, t in self._files.iteritems() if now - t.last_change > self.idle_timeout]:
+            self._evict(name)
+
+        return lines
+
+    def watched(self):
+        return len(self._files)
+
+    def close(self):
+        for name in self._files.keys():
+            self._evict(name)
+
+        if self._inotify:
+            self._inotify.close()
+            self._inotify = None
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+
+'''
+Fixed size binary stats records sent over a local UNIX datagram socket, from
+RTPgen style tools to GstreamerRTPAgentViz, so metrics do not go through log
+files. Run as a script, this is a shim for tools which only write text logs:
+
+    RTPgenClient -p 5000 | stats_socket.py --socket /tmp/rtpviz.sock --stream 5000
+'''
+
+import argparse
+import errno
+import logging
+import math
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+
+from stream_stats import parse_line
+
+log = logging.getLogger(__name__)
+
+# magic, version, flags, stream, time sent, fps, jitter (ms), running total of dropped frames.
+record = struct.Struct('=4sBB2x16sdffI')
+_magic = 'RTPS'
+_version = 1
+
+# which of the optional fields a record has.
+FPS = 0x01
+JITTER = 0x02
+DROPPED = 0x04
+STALLED = 0x08
+
+def pack_record(stream, fps=None, jitter=None, dropped=None, stalled=False, when=None):
+    flags = (FPS if fps is not None else 0) | (JITTER if jitter is not None else 0) | \
+        (DROPPED if dropped is not None else 0) | (STALLED if stalled else 0)
+    return record.pack(_magic, _version, flags, str(stream)[:16], when or time.time(),
+                       fps or 0.0, jitter or 0.0, dropped or 0)
+
+def unpack_record(data, offset=0):
+    '''The (stream, time, sample) in a record, sample as given to StreamStats.add(). None if it is not a record.'''
+    magic, version, flags, stream, when, fps, jitter, dropped = record.unpack_from(data, offset)
+    if magic != _magic or version != _version:
+        return None
+
+    sample = {}
+    if flags & FPS and not math.isnan(fps):
+        sample['fps'] = fps
+    if flags & JITTER and not math.isnan(jitter):
+        sample['jitter'] = jitter
+    if flags & DROPPED:
+        sample['dropped'] = dropped
+    if flags & STALLED:
+        sample['stalled'] = True
+
+    return stream.rstrip('\0'), when, sample
+
+class StatsSocket(object):
+    '''
+        Receive stats records on a UNIX datagram socket at path and hand each
+        to add(stream, **sample), from a thread of its own. A datagram may hold
+        any number of whole records.
+    '''
+    def __init__(self, path, add):
+        self.path = path
+        self.add = add
+        self.received = 0
+        self.rejected = 0
+        self._sock = None
+        self._thread = None
+        self._stopping = False
+
+    def start(self):
+        try:
+            os.unlink(self.path)    # left by an earlier run.
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._sock.bind(self.path)
+        os.chmod(self.path, 0666)   # tools may run as anyone.
+        self._sock.settimeout(0.5)  # to notice stop().
+        self._stopping = False
+        self._thread = threading.Thread(target=self._receive)
+        self._thread.daemon = True
+        self._thread.start()
+        log.info('Receiving stats records on {}'.format(self.path))
+
+    def _receive(self):
+        while not self._stopping:
+            try:
+                data = self._sock.recv(65536)
+            except socket.timeout:
+                continue
+            except socket.error as e:
+                if not self._stopping:
+                    log.error('Error receiving stats on {}: {}'.format(self.path, e))
+                break
+
+            if len(data) % record.size:
+                self.rejected += 1
+                continue
+
+            for offset in xrange(0, len(data), record.size):
+                rec = unpack_record(data, offset)
+                if rec is None:
+                    self.rejected += 1
+                    continue
+
+                stream, _, sample = rec
+                self.received += 1
+                try:
+                    self.add(stream, **sample)
+                except Exception as e:
+                    log.warn('Problem adding stats record from {}: {}'.format(stream, e))
+
+    def stop(self):
+        if not self._sock:
+            return
+
+        self._stopping = True
+        self._thread.join()
+        self._sock.close()
+        self._sock = None
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+        log.info('Received {} stats records on {}, rejected {}.'.format(self.received, self.path, self.rejected))
+
+class StatsSender(object):
+    '''Send stats records to a StatsSocket. Records are dropped, not queued, when no one is listening.'''
+    def __init__(self, path):
+        self.path = path
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+
+    def send(self, stream, **sample):
+        try:
+            self._sock.sendto(pack_record(stream, **sample), self.path)
+            return True
+        except socket.error:
+            return False
+
+    def close(self):
+        self._sock.close()
+
+def main():
+    parser = argparse.ArgumentParser(description='Send the stats in a text RTPgen log (read on stdin) as stats records.')
+    parser.add_argument('--socket', required=True, help='The path of the StatsSocket.')
+    parser.add_argument('--stream', required=True, help='The name of the stream, usually its port.')
+    parser.add_argument('--tee', action='store_true', help='Also copy stdin to stdout.')
+    args = parser.parse_args()
+
+    sender = StatsSender(args.socket)
+    for line in iter(sys.stdin.readline, ''):
+        if args.tee:
+            sys.stdout.write(line)
+            sys.stdout.flush()
+
+        sample = parse_line(line)
+        if sample:
+            sender.send(args.stream, **sample)
+
+    sender.close()
+
+if __name__ == '__main__':
+    main()
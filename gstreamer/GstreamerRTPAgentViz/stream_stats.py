@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+
+import logging
+import math
+import os
+import re
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# What RTPgen tools write to their logs. Anything else on a line is ignored.
+_fps = re.compile(r'FPS:\s*([0-9]+(?:\.[0-9]*)?)')
+_jitter = re.compile(r'jitter(?:\s*\(ms\))?\s*[:=]\s*([0-9]+(?:\.[0-9]*)?)', re.IGNORECASE)
+_dropped = re.compile(r'drop(?:ped|s)?\s*[:=]\s*([0-9]+)', re.IGNORECASE)
+# a stall event ("stall", "stalled"), not a counter such as "stalls: 0".
+_stall = re.compile(r'\bstall(?:ed)?\b(?!\s*[:=])', re.IGNORECASE)
+
+def parse_line(line):
+    '''The metrics on a log line: a dict with any of fps, jitter (ms), dropped (a running total) and stalled.'''
+    sample = {}
+    for key, regex, kind in [('fps', _fps, float), ('jitter', _jitter, float), ('dropped', _dropped, int)]:
+        m = regex.search(line)
+        if m:
+            sample[key] = kind(m.group(1))
+
+    if _stall.search(line):
+        sample['stalled'] = True
+
+    return sample
+
+def stream_name(filename):
+    '''
+        The stream a log file is for. GstreamerRTPAgent names them
+        <time>_<run>_<node>_<port>.log, so that is the port if there is one.
+    '''
+    base = os.path.splitext(os.path.basename(filename))[0]
+    port = base.rsplit('_', 1)[-1]
+    return port if port.isdigit() else base
+
+def percentile(values, p):
+    '''The nearest rank p'th percentile of values, which must be sorted.'''
+    if not values:
+        return None
+
+    return values[max(int(math.ceil(p / 100.0 * len(values))) - 1, 0)]
+
+class _Stream(object):
+    def __init__(self):
+        self.fps = []
+        self.jitter = []
+        self.drops = 0
+        self.stalls = 0
+        self.stalled = False
+        self.dropped_total = None   # the last running total of dropped frames seen.
+        self.last_seen = time.time()
+
+class StreamStats(object):
+    '''
+        Video quality of each stream over a reporting interval. Samples are added
+        as they are read and document() returns (and starts over) the interval's
+        per stream FPS, jitter, dropped frames and stalls, plus how the FPS is
+        distributed across the streams.
+
+        Dropped frames are logged as a running total; a stream's drops are the
+        increase over the total seen before (the first total seen is the
+        baseline). A stall starts when a stream's FPS falls below stall_fps, it
+        logs one, or it goes silent for silence seconds, and lasts until its FPS
+        recovers. Every stream seen is in every document, a silent one with an
+        FPS of 0 (or None, while it is silent for less than silence seconds),
+        until it has been silent for forget_after seconds.
+
+        Samples may be added from any thread.
+    '''
+    def __init__(self, stall_fps=1.0, silence=2.0, forget_after=60):
+        self.stall_fps = stall_fps
+        self.silence = silence
+        self.forget_after = forget_after
+        self._streams = {}      # name --> _Stream
+        self._lock = threading.Lock()
+
+    def add_line(self, stream, line):
+        sample = parse_line(line)
+        if sample:
+            self.add(stream, **sample)
+
+        return bool(sample)
+
+    def add(self, stream, fps=None, jitter=None, dropped=None, stalled=False):
+        with self._lock:
+            self._add(stream, fps, jitter, dropped, stalled)
+
+    def _add(self, stream, fps, jitter, dropped, stalled):
+        s = self._streams.get(stream)
+        if not s:
+            s = self._streams[stream] = _Stream()
+
+        s.last_seen = time.time()
+
+        if fps is not None:
+            s.fps.append(fps)
+            if fps < self.stall_fps:
+                stalled = True
+            elif not stalled:
+                s.stalled = False
+
+        if jitter is not None:
+            s.jitter.append(jitter)
+
+        if dropped is not None:
+            if s.dropped_total is not None:
+                # a smaller total means the tool restarted and counts from 0 again.
+                s.drops += dropped - s.dropped_total if dropped >= s.dropped_total else dropped
+
+            s.dropped_total = dropped
+
+        if stalled and not s.stalled:
+            s.stalls += 1
+            s.stalled = True
+
+    def document(self):
+        '''
+            A document of the interval, with an entry per stream in each of the
+            per stream arrays, or None if there are no streams.
+        '''
+        with self._lock:
+            return self._document()
+
+    def _document(self):
+        now = time.time()
+        for name in [n for n, s in self._streams.iteritems() if now - s.last_seen > self.forget_after]:
+            del self._streams[name]
+
+        names = sorted(self._streams)
+        if not names:
+            return None
+
+        streams = [self._streams[n] for n in names]
+        fps = []
+        for s in streams:
+            if s.fps:
+                fps.append(sum(s.fps) / len(s.fps))
+            elif now - s.last_seen > self.silence:
+                # the worst stall of all: no frames, so nothing logged.
+                fps.append(0.0)
+                if not s.stalled:
+                    s.stalls += 1
+                    s.stalled = True
+            else:
+                fps.append(None)
+
+        jitter = [sum(s.jitter) / len(s.jitter) if s.jitter else None for s in streams]
+        doc = {
+            'streams': names,
+            'fps': fps,
+            'jitter': jitter,
+            'drops': [s.drops for s in streams],
+            'stalls': [s.stalls for s in streams],
+            'drops_total': sum(s.drops for s in streams),
+            'stalls_total': sum(s.stalls for s in streams),
+            'stalled_streams': sum(1 for s in streams if s.stalled),
+        }
+
+        reported = sorted(f for f in fps if f is not None)
+        if reported:
+            doc['frame_rate'] = sum(reported) / len(reported)
+            doc['fps_min'] = reported[0]
+            doc['fps_p10'] = percentile(reported, 10)
+            doc['fps_median'] = percentile(reported, 50)
+
+        reported = sorted(j for j in jitter if j is not None)
+        if reported:
+            doc['jitter_median'] = percentile(reported, 50)
+            doc['jitter_max'] = reported[-1]
+
+        for s in streams:
+            s.fps, s.jitter, s.drops, s.stalls = [], [], 0, 0
+
+        return doc
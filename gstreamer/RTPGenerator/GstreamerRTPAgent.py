@@ -4,17 +4,17 @@ from magi.util.processAgent import initializeProcessAgent
 from magi.testbed import testbed
 from time import gmtime, strftime, localtime
 from shutil import copy
-from time import sleep
+from time import sleep, time
 import os.path
 import os
 import sys
 import signal
 import stat
 
-from subprocess import CalledProcessError, Popen, STDOUT, call
-
 import logging
 
+from process_supervisor import ProcessSupervisor, exit_trigger
+
 logging.basicConfig()
 log = logging.getLogger(__name__)
 
@@ -37,9 +37,13 @@ class GstreamerRTPAgent(DispatchAgent):
         self.start_port = 5000
         self.logdir = os.path.join('/', 'tmp', 'magi_gstreamer_rtp')
         self.runname = ''       # include this in log file name if given.
+        self.stop_timeout = 1.0 # seconds to wait after SIGINT before killing a process.
+        self.start_timeout = 10 # seconds to wait for all flows to be ready.
+        self.start_retries = 2  # times to restart a process that exits before it is ready.
+        self.settle_time = 0.5  # a server (sender) is ready once it has run this long.
 
         # do not touch below here.
-        self._procs = []
+        self._supervisor = ProcessSupervisor(exit_trigger(self, testbed.nodename))
         self._isrunning = False
         self._logfds = []
 
@@ -100,96 +104,103 @@ class GstreamerRTPAgent(DispatchAgent):
                 logfd = None
             except:
                 pass
+
+        self._logfds = []
                 
     def startTraffic(self, msg):
-        '''Start gstreamer RTP servers/clients.'''
-        #log.info('Stopping older gstreamer RTP processes (Found %d).' % (len(self._procs)))
-        self.stopTraffic(msg)
-        
+        '''
+            Start gstreamer RTP servers/clients. All the flows on this node are
+            started at once, then waited on together until they are ready: a
+            client (receiver) once its UDP port is bound, a server (sender) once
+            it has run for settle_time. Processes which exit before then are
+            restarted, up to start_retries times.
+        '''
+        if self._supervisor.names():
+            self.stopTraffic(msg)
+
+        flows = {}  # name --> (cmd, port, is client)
         port_offset = 0    
         log.info("Should start %d flows." % len(self.flows))
         for f in self.flows:
-            cmd = None
+            port = self.start_port + port_offset
+            port_offset = port_offset + 1
             if f['client'] == testbed.nodename:
-                cmd = 'RTPgenClient -p {} {}'.format(self.start_port + port_offset, self.client_args)
+                flows['client_{}'.format(port)] = ('RTPgenClient -p {} {}'.format(port, self.client_args), port, True)
             elif f['server'] == testbed.nodename:
-                cmd = 'RTPgenServer -p {} -c {} {}'.format(self.start_port + port_offset, f['client'], self.server_args)
-
-            if cmd:
-                log.info("Trying command %s" % cmd)
-                # try a few times in case the servers have not started.
-                count = 5
-                while count:
-                    try:
-                        log.info('Running gstreamer RTP as: "{}"'.format(cmd))
-                        fd = self._get_logfd(self.start_port + port_offset)
-                        proc = None
-                        proc = Popen(cmd.split(), stdout=fd, stderr=STDOUT, close_fds=True)
-                        self._procs.append(proc)
-                    except CalledProcessError as e:
-                        log.error('Unable to start RTP gstreamer process: {}'.format(e))
-                  
-                    if proc:
-                        sleep(1)    # let it fail or no.
-                        if proc.poll():   # poll() returns None if proc running else exit value.
-                            log.info('Error starting gstreamer RTP. Trying again.')
-                        else:
-                             break
-
-                    log.info('Unable to start gstreamer RTP trying again in a few seconds....')
-                    count = count-1
-                    sleep(1)
-            else:
-                log.warn('Unable to determine command to start on this instance.')
-            
-            port_offset = port_offset + 1
-        
-        if len(self._procs) > 0:
-            log.info("%d processes started." % len(self._procs))
-            return True
-        else:
-            log.warn("Failed to start any processes.")
+                flows['server_{}'.format(port)] = (
+                    'RTPgenServer -p {} -c {} {}'.format(port, f['client'], self.server_args), port, False)
+
+        if not flows:
+            log.warn('Unable to determine command to start on this instance.')
             return False
 
+        logfds = {}
+        started = {}    # name --> when its current process started
+        for name, (cmd, port, _) in flows.iteritems():
+            logfds[name] = self._get_logfd(port)
+            if self._supervisor.start(name, cmd, stdout=logfds[name]):
+                started[name] = time()
+            else:
+                log.error('Unable to start RTP gstreamer process: {}'.format(cmd))
+
+        deadline = time() + float(self.start_timeout)
+        retries = dict((name, int(self.start_retries)) for name in started)
+        ready = []
+        delay = 0.005
+        while started and time() < deadline:
+            bound = self._udp_ports()
+            for name, when in started.items():
+                cmd, port, client = flows[name]
+                if not self._supervisor.running(name):
+                    returncode = self._supervisor.wait(name, 0)
+                    if retries[name] and self._supervisor.start(name, cmd, stdout=logfds[name]):
+                        log.info('{} exited with {} before it was ready, restarting it.'.format(name, returncode))
+                        retries[name] -= 1
+                        started[name] = time()
+                    else:
+                        log.error('{} exited with {}: {}'.format(name, returncode, cmd))
+                        del started[name]
+                elif (client and port in bound) or (not client and time() - when >= float(self.settle_time)):
+                    ready.append(name)
+                    del started[name]
+
+            if started:
+                sleep(delay)
+                delay = min(delay * 2, 0.1)
+
+        for name in started:
+            log.warn('{} not ready after {}s'.format(name, self.start_timeout))
+
+        log.info("%d of %d processes ready." % (len(ready), len(flows)))
+        return len(ready) == len(flows)
+
+    @staticmethod
+    def _udp_ports():
+        '''The local UDP ports bound.'''
+        ports = set()
+        for path in ['/proc/net/udp', '/proc/net/udp6']:
+            try:
+                with open(path) as fd:
+                    next(fd)
+                    for line in fd:
+                        ports.add(int(line.split()[1].rsplit(':', 1)[1], 16))
+            except (IOError, OSError, StopIteration):
+                pass
+
+        return ports
+
     def stopTraffic(self, msg):
-        log.info("Stopping traffic. Have %d processes to kill." % (len(self._procs)))
-        for proc in self._procs:
-            if proc and not proc.poll():
-                # First try to send a break so program can clean up.
-                try:
-                    log.info('warning program of upcoming end')
-                    proc.send_signal(signal.SIGINT)
-                    sleep(1)
-                except OSError:
-                    pass # ok
-                try:
-                    log.info('killing gstreamer RTP')
-                    proc.kill()
-                    sleep(1)
-                    if proc.poll():
-                        self._procs.remove(proc)
-                except OSError as e:
-                    log.warn("Error while killing proc %s (No such process errors are probably ok)" % (e))
-                    pass   # fine.
-        if len(self._procs) > 0:
-            log.warn("Failed to kill %d processes." % (len(self._procs)))
+        names = self._supervisor.names()
+        log.info("Stopping traffic. Have %d processes to stop." % len(names))
+        # First send a break so programs can clean up, then kill what is left.
+        statuses = self._supervisor.stop_all(names, signal.SIGINT, float(self.stop_timeout))
+        killed = [n for n, rc in statuses.iteritems() if rc == -signal.SIGKILL]
+        if killed:
+            log.warn("Had to kill %d processes: %s" % (len(killed), ', '.join(killed)))
         else:
-            log.info("Killed all processes.")
+            log.info("Stopped all processes.")
 
         self._clear_logfds()
-
-        # Just to be safe. 
-        try:
-            log.info('pkilling gstreamer RTP')
-            call('pkill -signal 6 -f RTPgenClient'.split())
-            call('pkill -signal 6 -f RTPgenServer'.split())
-            sleep(1)
-            call('pkill -f RTPgenClient'.split())
-            call('pkill -f RTPgenServer'.split())
-        except CalledProcessError as e:
-            log.info('error pkilling gstreamer RTP: {}'.format(e))
-            pass
-
         return True
 
 def getAgent(**kwargs):
@@ -5,15 +5,18 @@ from magi.util.processAgent import initializeProcessAgent
 from magi.testbed import testbed
 from time import gmtime, strftime
 from shutil import copy
-from time import sleep
+from time import sleep, time
 import os.path
 import os
+import signal
+import socket
 import stat
-
-from subprocess import CalledProcessError, Popen, STDOUT, call
+import threading
 
 import logging
 
+from process_supervisor import ProcessSupervisor, exit_trigger
+
 log = logging.getLogger(__name__)
 
 class GstreamerRTSPAgent(DispatchAgent):
@@ -35,12 +38,13 @@ class GstreamerRTSPAgent(DispatchAgent):
         self.logdir = os.path.join('/', 'tmp', 'magi_gstreamer_rtsp')
         self.runname = ''       # include this in log file name if given.
         self.json = True        # if True, output json logs instead of text.
+        self.stop_timeout = 1.0 # seconds to wait after SIGINT before killing a process.
+        self.start_timeout = 10 # seconds to wait for servers to answer RTSP OPTIONS.
 
         # do not touch below here.
-        self._proc = []
+        self._supervisor = ProcessSupervisor(exit_trigger(self, testbed.nodename))
         self._isrunning = False
         self._logfd = None
-        self._started_servers = {}
 
         self._loglevel = 'info'
 
@@ -93,118 +97,156 @@ class GstreamerRTSPAgent(DispatchAgent):
             self._logfd.close()
             self._logfd = None
 
+    def _flow_ports(self):
+        '''
+            The RTSP port of each flow. A flow may give its own 'port', the others
+            get the next free port after start_port, in flow order. Every node
+            computes the same ports from the same flows.
+        '''
+        taken = set(int(f['port']) for f in self.flows if 'port' in f)
+        ports = []
+        port = int(self.start_port)
+        for f in self.flows:
+            if 'port' in f:
+                ports.append(int(f['port']))
+                continue
+
+            port += 1
+            while port in taken:
+                port += 1
+
+            taken.add(port)
+            ports.append(port)
+
+        return ports
+
+    @staticmethod
+    def _rtsp_ready(host, port, timeout):
+        '''True if an RTSP server at host:port answers OPTIONS with 200.'''
+        try:
+            sock = socket.create_connection((host, port), timeout)
+        except (socket.error, socket.timeout):
+            return False
+
+        try:
+            sock.settimeout(timeout)
+            sock.sendall('OPTIONS rtsp://{}:{}/ RTSP/1.0\r\nCSeq: 1\r\n\r\n'.format(host, port))
+            reply = ''
+            while '\r\n' not in reply:
+                data = sock.recv(1024)
+                if not data:
+                    break
+
+                reply += data
+
+            return reply.split(' ', 2)[1:2] == ['200']
+        except (socket.error, socket.timeout):
+            return False
+        finally:
+            sock.close()
+
+    def _wait_rtsp(self, host, port, deadline, name=None):
+        '''
+            Probe host:port with OPTIONS until it answers or deadline passes. If
+            name is given, give up as soon as that (local) process exits.
+        '''
+        delay = 0.01
+        while True:
+            if self._rtsp_ready(host, port, max(min(deadline - time(), 1.0), 0.1)):
+                return True
+
+            if name and not self._supervisor.running(name):
+                log.error('RTSP server {} exited with {}'.format(name, self._supervisor.wait(name, 0)))
+                return False
+
+            if time() + delay >= deadline:
+                log.error('RTSP server {}:{} not ready after {}s'.format(host, port, self.start_timeout))
+                return False
+
+            sleep(delay)
+            delay = min(delay * 2, 0.25)
+
+    def _concurrently(self, fn, argslist):
+        '''Call fn with each args in argslist, each in its own thread. Returns the results in order.'''
+        results = [None] * len(argslist)
+        def run(i, args):
+            try:
+                results[i] = fn(*args)
+            except Exception as e:
+                log.error('Error starting {}: {}'.format(args, e))
+                results[i] = False
+
+        threads = [threading.Thread(target=run, args=(i, args)) for i, args in enumerate(argslist)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+
+        for t in threads:
+            t.join()
+
+        return results
+
     def start_servers(self, msg):
-        '''Start gstreamer RTSP servers.'''
-        if len(self._proc) > 0:
+        '''Start this node's gstreamer RTSP servers, all at once, and wait for them to answer RTSP.'''
+        servers = [n for n in self._supervisor.names() if n.startswith('server_')]
+        if servers:
             log.info('Stopping older RTSP servers.')
-            self.stop_servers()
-        port_offset = 0
-        for f in self.flows:
-            port_offset = port_offset + 1
-            self._started_servers[f['server']] = self.start_port + port_offset
-            cmd = None
-            _proc = None
+            self._supervisor.stop_all(servers, signal.SIGINT, float(self.stop_timeout))
+
+        deadline = time() + float(self.start_timeout)
+        waiting = []
+        for f, port in zip(self.flows, self._flow_ports()):
             if f['server'] == testbed.nodename:
-                cmd = '/usr/local/bin/RTSPgenServer -p {}'.format(self.start_port + port_offset)
-            if cmd:
-                count = 5
-                while count:
-                    try:
-                        log.info('running gstreamer RTSP server as: "{}"'.format(cmd))
-                        fd = self._get_logfd()
-                        _proc = Popen(cmd.split(), stdout=fd, stderr=STDOUT, close_fds=True)
-                    except CalledProcessError as e:
-                        log.error('Unable to start RTSP gstreamer process: {}'.format(e))
-                        self._clear_logfd()
-                        _proc = None
-                    if self._proc:
-                        sleep(1)
-                        if _proc.poll():
-                            log.info('Error starting gstreamer RTSP server. Trying again.')
-                        else:
-                            break
-                    log.info('Unable to start gstreamer RTSP server, trying again in a fwe seconds...')
-                    count = count-1
-                    sleep(1)
-                if _proc != None:
-                    log.info('gstreamer RTSP server %s:%d started' % (f['server'], self.start_port + port_offset))
-                    self._proc.append(_proc)
+                cmd = '/usr/local/bin/RTSPgenServer -p {}'.format(port)
+                log.info('running gstreamer RTSP server as: "{}"'.format(cmd))
+                name = 'server_{}'.format(port)
+                if self._supervisor.start(name, cmd, stdout=self._get_logfd()):
+                    waiting.append(('127.0.0.1', port, deadline, name))
                 else:
-                    log.warn('Problem starting server on %s:%d' %(f['server'], self.start_port + port_offset))
+                    log.warn('Problem starting server on %s:%d' %(f['server'], port))
+                    return False
+
+        ready = self._concurrently(self._wait_rtsp, waiting)
+        log.info('{} of {} RTSP servers ready'.format(sum(ready), len(waiting)))
+        return all(ready)
+
+    def _start_client(self, name, server, port, cmd, deadline):
+        if not self._wait_rtsp(server, port, deadline):
+            return False
+
+        log.info('running gstreamer RTSP as: "{}"'.format(cmd))
+        return self._supervisor.start(name, cmd, stdout=self._get_logfd()) is not None
 
     def startTraffic(self, msg):
-        '''Start gstreamer RTSP clients.'''
-        if len(self._proc) > 0:
+        '''
+            Start gstreamer RTSP servers, then clients. Each flow has its own
+            port. Clients are started in parallel, each as soon as its server
+            answers an RTSP OPTIONS request.
+        '''
+        if self._supervisor.names():
             log.info('Stopping older gstreamer RTSP processes.')
             self.stopTraffic(msg)
         
-        self.start_servers(msg)
-        
-        port_offset = 0    
-        for f in self.flows:
-            cmd = None
-            _proc = None
-            port_offset = port_offset + 1
+        self._get_logfd()   # open it before the threads need it.
+        if not self.start_servers(msg):
+            return False
+
+        deadline = time() + float(self.start_timeout)
+        clients = []
+        for i, (f, port) in enumerate(zip(self.flows, self._flow_ports())):
             if f['client'] == testbed.nodename:
-                if f['server'] in self._started_servers:
-                    port = self._started_servers[f['server']]
-                    cmd = '/usr/local/bin/RTSPgenClient -p {} -s {}'.format(port, f['server'])
-                else:
-                    log.error('Cannot determine port of server. Was server (%s) started?' % f['server'])
-
-            if cmd:
-                # try a few times in case the servers have not started.
-                count = 5
-                while count:
-                    try:
-                        log.info('running gstreamer RTSP as: "{}"'.format(cmd))
-                        fd = self._get_logfd()
-                        _proc = Popen(cmd.split(), stdout=fd, stderr=STDOUT, close_fds=True)
-                    except CalledProcessError as e:
-                        log.error('Unable to start RTSP gstreamer process: {}'.format(e))
-                        self._clear_logfd()
-                        _proc = None
-                  
-                    if _proc:
-                        sleep(1)    # let it fail or no.
-                        if _proc.poll():   # poll() returns None if proc running else exit value.
-                            log.info('Error starting gstreamer RTP. Trying again.')
-                        else:
-                             break
-
-                    log.info('Unable to start gstreamer RTSP trying again in a few seconds....')
-                    count = count-1
-                    sleep(1)
-                if _proc != None:
-                    log.info('gstreamer RTSP client started on %s' % (f['client']))
-                    self._proc.append(_proc)
-                else:
-                    return False
-        return True
+                cmd = '/usr/local/bin/RTSPgenClient -p {} -s {}'.format(port, f['server'])
+                clients.append(('client_{}'.format(i), f['server'], port, cmd, deadline))
 
+        started = self._concurrently(self._start_client, clients)
+        log.info('{} of {} gstreamer RTSP clients started on {}'.format(
+            sum(started), len(clients), testbed.nodename))
+        return all(started)
 
     def stopTraffic(self, msg):
-        for proc in self._proc:
-            if proc and not proc.poll():
-                try:
-                    log.info('killing gstreamer RTSP client')
-                    proc.kill()
-                except OSError:
-                    pass   # meh.
-
+        log.info('stopping gstreamer RTSP clients and servers')
+        self._supervisor.stop_all(term_signal=signal.SIGINT, timeout=float(self.stop_timeout))
         self._clear_logfd()
-        self._proc = []
-
-        # Just to be safe. 
-        try:
-            log.info('pkilling gstreamer RTSP')
-            # XXX not as specific as it should be.
-            call('pkill -f "RTSPgenClient"'.split(), shell=True)
-            call('pkill -f "RTSPgenServer"'.split(), shell=True)
-        except CalledProcessError as e:
-            log.info('error pkilling gstreamer RTSP clients: {}'.format(e))
-            pass
-
         return True
 
 def getAgent(**kwargs):
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+
+import ast
+import logging
+
+from collections import deque
+
+from magi.util import distributions
+
+log = logging.getLogger(__name__)
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+def _cap(values, cap):
+    return values if cap is None else numpy.minimum(values, cap)
+
+# numpy versions of the magi.util.distributions functions which return n samples at once.
+_vectorized = {
+    'minmax': lambda n, low, high: numpy.random.uniform(low, high, n),
+    'pareto': lambda n, alpha, scale=1.0, cap=None: _cap((numpy.random.pareto(alpha, n)+1)*scale, cap),
+    'gamma': lambda n, alpha, rate, cap=None: _cap(numpy.random.gamma(alpha, 1.0/rate, n), cap),
+    'expo': lambda n, lambd, scale=1.0, cap=None: _cap(numpy.random.exponential(1.0/lambd, n)*scale, cap),
+}
+
+class DistributionSampler(object):
+    '''
+        Draw values from a magi.util.distributions expression (e.g. "minmax(1000, 5000)")
+        without evaluating the expression string for every value.
+
+        The expression is parsed once. Constants are returned as is, distribution
+        calls with constant arguments are sampled batch at a time via numpy (when
+        available), anything else is compiled once and evaluated batch at a time.
+        Traffic shaping adjusts the offset added to each value rather than the
+        expression itself.
+    '''
+    def __init__(self, expression, batch=1024):
+        self.expression = str(expression)
+        self.offset = 0.0
+        self._batch = batch
+        self._values = deque()
+        self._constant = None
+        self._generate = None
+
+        try:
+            self._constant = float(self.expression)
+            return
+        except ValueError:
+            pass
+
+        tree = ast.parse(self.expression.strip(), mode='eval')
+        call = tree.body
+        if numpy and isinstance(call, ast.Call) and isinstance(call.func, ast.Name) and \
+                call.func.id in _vectorized and not call.keywords:
+            try:
+                args = [ast.literal_eval(arg) for arg in call.args]
+            except ValueError:
+                args = None
+
+            if args is not None:
+                func = _vectorized[call.func.id]
+                self._generate = lambda n: func(n, *args).tolist()
+                return
+
+        code = compile(tree, '<distribution>', 'eval')
+        namespace = dict(vars(distributions))
+        self._generate = lambda n: [eval(code, namespace) for _ in xrange(n)]
+
+    def sample(self):
+        '''Return the next value, never less than zero.'''
+        if self._constant is not None:
+            return max(self._constant + self.offset, 0)
+
+        while True:
+            try:
+                value = self._values.popleft()
+                break
+            except IndexError:
+                self._values.extend(self._generate(self._batch))
+
+        return max(value + self.offset, 0)
+
+    def adjust(self, delta):
+        '''Shift all future values by delta.'''
+        self.offset += delta
+        if self._constant is not None:
+            # do not let a constant be pushed below zero, so a later increase starts from zero.
+            self.offset = max(self.offset, -self._constant)
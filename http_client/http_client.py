@@ -4,13 +4,21 @@
 # This software is licensed under the GPLv3 license, included in
 # ./GPLv3-LICENSE.txt in the source distribution
 
-from magi.util.agent import TrafficClientAgent
+from magi.util.agent import TrafficClientAgent, agentmethod
 from magi.util.processAgent import initializeProcessAgent
 from magi.util.distributions import *
+from magi.util import database
+from distribution_sampler import DistributionSampler
+from http_transport import HttpTransport
+from open_loop import OpenLoopScheduler
 
+import httplib
 import logging
 import random
+import socket
 import sys
+import threading
+import time
 
 
 log = logging.getLogger(__name__)
@@ -25,6 +33,7 @@ class HttpAgent(TrafficClientAgent):
 
         # Can be support distribution function (look magi.util.distributions)
         self.sizes = '1000'
+        self._sizes = None   # DistributionSampler for sizes.
         self.url = "http://%s/gettext/%d"
 
         # SOCKS support
@@ -33,33 +42,101 @@ class HttpAgent(TrafficClientAgent):
         self.socksPort = 5010
         self.socksVersion = 4
 
+        # "curl" forks a curl process per request. "http" fetches in process over
+        # a pool of keep-alive connections. SOCKS always uses curl.
+        self.transport = 'curl'
+
+        # If True, start requests at the times given by interval whether or not
+        # earlier requests have finished (open loop) using up to workers
+        # concurrent requests, rather than waiting for each request to finish
+        # before scheduling the next (closed loop).
+        self.open_loop = False
+        self.workers = 16
+
+        self._transport = None
+        self._scheduler = None
+        self._lock = threading.Lock()  # open loop workers set up _transport and _sizes concurrently.
+
+    def oneClient(self):
+        """ Called when the next client should fire (after interval time) """
+        if self.transport != 'http' or self.useSocks:
+            return TrafficClientAgent.oneClient(self)
+
+        if len(self.servers) < 1:
+            log.warning("no servers to contact, nothing to do")
+            return
+
+        dst = self.servers[random.randint(0, len(self.servers) - 1)]
+        try:
+            m = self._get_transport().fetch(self.url % (dst, int(self._size_sampler().sample())))
+        except (httplib.HTTPException, socket.error) as e:
+            log.error("error fetching from %s: %s", dst, e)
+            return
+
+        # log the same line our curl command writes.
+        output = 'data=%s,%.3f,%.3f,%d,%.3f\n' % (m['url'], m['time'], m['start_transfer_time'],
+                                                m['size'], m['speed'])
+        fp = open(self.logfile, 'a')
+        fp.write(str(time.time()) + "\t" + output)
+        fp.close()
+
+    @agentmethod()
+    def startClient(self, msg):
+        if not self.open_loop:
+            return TrafficClientAgent.startClient(self, msg)
+
+        self._size_sampler()
+        self._scheduler = OpenLoopScheduler(self.oneClient, DistributionSampler(self.interval),
+                                            workers=int(self.workers),
+                                            report=database.getCollection(self.name + '_schedule').insert,
+                                            abort=self._get_transport().abort)
+        self._scheduler.start()
+        return True
+
+    @agentmethod()
+    def stopClient(self, msg):
+        if not self._scheduler:
+            return TrafficClientAgent.stopClient(self, msg)
+
+        self._scheduler.stop()
+        self._scheduler = None
+        return True
+
     def getCmd(self, dst):
         cmd = 'curl -o /dev/null -s -S -w data=%{url_effective},%{time_total},%{time_starttransfer},%{size_download},%{speed_download}\\n '
         if self.useSocks:
             socks_cmd = " --proxy socks%d://%s:%d" % (int(self.socksVersion), self.socksServer, int(self.socksPort))
             cmd += socks_cmd
-	cmd = "%s %s" % (cmd, (self.url % (dst, eval(self.sizes))))
+	cmd = "%s %s" % (cmd, (self.url % (dst, int(self._size_sampler().sample()))))
 	return cmd	
         
+    def _get_transport(self):
+        with self._lock:
+            if not self._transport:
+                self._transport = HttpTransport()
+
+            return self._transport
+
+    def _size_sampler(self):
+        # rebuild the sampler only when the sizes expression is (re)configured.
+        with self._lock:
+            if not self._sizes or self._sizes.expression != str(self.sizes):
+                self._sizes = DistributionSampler(self.sizes)
+
+            return self._sizes
+
     def increaseTraffic(self, msg, stepsize):
-        self.sizes = eval(self.sizes) + stepsize
-        self.sizes = str(self.sizes)
+        self._size_sampler().adjust(stepsize)
 
     def reduceTraffic(self, msg, stepsize):
-        self.sizes = eval(self.sizes) - stepsize
-        if(self.sizes < 0):
-            self.sizes = 0
-        self.sizes = str(self.sizes)
+        self._size_sampler().adjust(-stepsize)
                
     def changeTraffic(self, msg, stepsize):
         prob = random.randint(0, 100)
         if prob in range(10):
-            self.sizes = eval(self.sizes) + int(stepsize * random.random())
+            self._size_sampler().adjust(int(stepsize * random.random()))
         elif prob in range(10, 20):
-            self.sizes = eval(self.sizes) - int(stepsize * random.random())
-            if(self.sizes < 0):
-                self.sizes = 0
-        self.sizes = str(self.sizes)
+            self._size_sampler().adjust(-int(stepsize * random.random()))
     
 def getAgent(**kwargs):
     agent = HttpAgent()
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+
+import errno
+import httplib
+import logging
+import socket
+import threading
+import time
+
+from urlparse import urlsplit
+
+log = logging.getLogger(__name__)
+
+class HttpTransport(object):
+    '''
+        A minimal in-process HTTP/1.1 GET client which keeps a pool of open
+        (keep-alive) connections per server. fetch() returns the same metrics
+        curl's -w output gives us, without forking a curl process per request.
+    '''
+    def __init__(self, timeout=60, max_idle=8):
+        self.timeout = timeout
+        self.max_idle = max_idle    # idle connections kept per server.
+        self._idle = {}             # host --> list of idle HTTPConnections.
+        self._active = set()        # HTTPConnections with a fetch() in progress.
+        self._aborted = set()       # those of them cut short by abort().
+        self._lock = threading.Lock()
+
+    def fetch(self, url):
+        '''
+            GET url and read (and discard) the body. Returns a dict with the
+            url, total time, time to the start of the transfer, the size of the
+            body, and the download speed. Raises httplib.HTTPException or
+            socket.error on failure, or if abort() cut the fetch short.
+        '''
+        parts = urlsplit(url)
+        path = parts.path + ('?' + parts.query if parts.query else '')
+        conn, reused = self._checkout(parts.netloc)
+        try:
+            start = time.time()
+            try:
+                response = self._request(conn, path)
+            except (httplib.HTTPException, socket.error):
+                if not reused:
+                    raise
+
+                # the server may have closed an idle connection. Try once more on a new one.
+                conn.close()
+                self._release(conn)
+                conn, reused = self._connect(parts.netloc), False
+                start = time.time()
+                response = self._request(conn, path)
+
+            start_transfer = time.time()
+            size = 0
+            while True:
+                chunk = response.read(65536)
+                if not chunk:
+                    break
+
+                size += len(chunk)
+
+            end = time.time()
+            if self._release(conn):
+                raise socket.error(errno.ECONNABORTED, 'fetch aborted')
+        except:
+            self._release(conn)
+            conn.close()
+            raise
+
+        if response.will_close:
+            conn.close()
+        else:
+            self._checkin(parts.netloc, conn)
+
+        total = end-start
+        return {
+            'url': url,
+            'status': response.status,
+            'time': total,
+            'start_transfer_time': start_transfer-start,
+            'size': float(size),
+            'speed': size/total if total > 0 else 0.0
+        }
+
+    def abort(self):
+        '''Cut short every fetch() in progress (they raise socket.error) and close the idle connections.'''
+        with self._lock:
+            for conn in self._active:
+                self._aborted.add(conn)
+                if conn.sock:
+                    try:
+                        # unlike close(), this wakes a thread blocked reading the socket.
+                        conn.sock.shutdown(socket.SHUT_RDWR)
+                    except socket.error:
+                        pass
+
+        self.close()
+
+    def close(self):
+        with self._lock:
+            for conns in self._idle.values():
+                for conn in conns:
+                    conn.close()
+
+            self._idle = {}
+
+    def _request(self, conn, path):
+        conn.request('GET', path)
+        return conn.getresponse()
+
+    def _checkout(self, host):
+        with self._lock:
+            conns = self._idle.get(host)
+            if conns:
+                conn = conns.pop()
+                self._active.add(conn)
+                return conn, True
+
+        return self._connect(host), False
+
+    def _connect(self, host):
+        conn = httplib.HTTPConnection(host, timeout=self.timeout)
+        with self._lock:
+            self._active.add(conn)
+
+        return conn
+
+    def _release(self, conn):
+        '''conn is no longer in use by a fetch(). Returns True if abort() cut that fetch short.'''
+        with self._lock:
+            self._active.discard(conn)
+            if conn in self._aborted:
+                self._aborted.discard(conn)
+                return True
+
+        return False
+
+    def _checkin(self, host, conn):
+        with self._lock:
+            conns = self._idle.setdefault(host, [])
+            if len(conns) < self.max_idle:
+                conns.append(conn)
+                return
+
+        conn.close()
@@ -2,15 +2,22 @@
 
 from magi.util.agent import DispatchAgent
 from magi.util.processAgent import initializeProcessAgent
+from magi.util import database
 from magi.testbed import testbed
+from libdeterdash import DeterDashboard
+from metrics_sink import MetricsSink
+from process_supervisor import ProcessSupervisor, exit_trigger
 from time import gmtime, strftime
 from shutil import copy
-from time import sleep
+from time import sleep, time
+import json
 import os.path
 import os
+import signal
 import stat
+import threading
 
-from subprocess import CalledProcessError, Popen, STDOUT, call
+from subprocess import PIPE
 
 import logging
 
@@ -34,11 +41,18 @@ class IperfAgent(DispatchAgent):
         self.logdir = os.path.join('/', 'tmp', 'iperf')
         self.runname = ''       # include this in log file name if given.
         self.json = True        # if True, output json logs instead of text.
+        self.base_port = 5201   # flow i is served on base_port+i unless the flow gives a 'port'.
+        self.start_timeout = 10 # seconds to wait for servers to listen.
+        self.stream_metrics = False # if True, run iperf3 --json-stream and insert each interval into the database.
+        self.metric_period = 1.0    # how often (seconds) buffered interval metrics are inserted.
+        self.stop_timeout = 2.0     # seconds to wait after SIGINT before killing iperf3.
 
         # do not touch below here.
-        self._proc = {}
+        self._supervisor = ProcessSupervisor(exit_trigger(self, testbed.nodename))
+        self._logfds = {}       # flow name --> its log file
+        self._readers = []      # threads reading --json-stream output.
+        self._sink = None
         self._isrunning = False
-        self._logfd = None
 
         self._loglevel = 'info'
 
@@ -74,95 +88,266 @@ class IperfAgent(DispatchAgent):
 
         return True
 
-    def _get_logfd(self):
-        if not self._logfd:
+    def _get_logfd(self, name):
+        if name not in self._logfds:
             # append _ to runname if there. 
             runname = '{}_'.format(self.runname) if self.runname else ''
-            filename = os.path.join(self.logdir, '{}_{}{}_iperf.log'.format(
+            filename = os.path.join(self.logdir, '{}_{}{}_{}_iperf.log'.format(
                 strftime("%Y%m%d_%H%M%S", gmtime()),
                 runname,
-                testbed.nodename))
-            self._logfd = open(filename, 'w')
+                testbed.nodename,
+                name))
+            self._logfds[name] = open(filename, 'w')
 
-        return self._logfd
+        return self._logfds[name]
 
-    def _clear_logfd(self):
-        if self._logfd:
-            self._logfd.close()
-            self._logfd = None
+    def _clear_logfds(self):
+        for fd in self._logfds.values():
+            fd.close()
 
-    def start_traffic(self, msg):
-        '''Start iperf everywhere.'''
-        if self._proc:
-            log.info('Stopping older iperf3 process.')
-            self.stop_traffic(msg)
-            
-        for f in self.flows:
-            cmd = None
+        self._logfds = {}
+
+    def _my_flows(self):
+        '''The (name, server, port, cmd) of the servers and clients this node runs.'''
+        servers, clients = [], []
+        for i, f in enumerate(self.flows):
+            port = int(f.get('port', int(self.base_port) + i))
             if f['server'] == testbed.nodename:
-                cmd = 'iperf3 -s '
+                servers.append(('server_{}'.format(port), None, port,
+                                'iperf3 -s -p {}'.format(port)))
             elif f['client'] == testbed.nodename:
-                cmd = 'iperf3 -c {} {}'.format(f['server'], self.client_args)
-
-            # iperf3 does not handle io buffering correctly, but it does seem to when --verbose
-            # is given. If we leave this out, we will frequently not capture all lines in the log
-            # file. 
-            if cmd:
-                cmd += ' --verbose'
-
-                if self.json:
-                    cmd += ' -J'
-
-            if cmd:
-                # try a few times in case teh servers have not started.
-                count = 5
-                while count:
-                    try:
-                        log.info('running iperf as: "{}"'.format(cmd))
-                        fd = self._get_logfd()
-                        self._proc = Popen(cmd.split(), stdout=fd, stderr=STDOUT, close_fds=True)
-                    except CalledProcessError as e:
-                        log.error('Unable to start iperf process: {}'.format(e))
-                        self._clear_logfd()
-                        self._proc = None
-                  
-                    if self._proc:
-                        sleep(1)    # let it fail or no.
-                        if self._proc.poll():   # poll() returns None if proc running else exit value.
-                            log.info('Error starting iperf. Trying again.')
-                        else:
-                             break
-
-                    log.info('Unable to start iperf trying again in a few seconds....')
-                    count = count-1
-                    sleep(1)
-
-                log.info('iperf started')
-                break
-
-        return self._proc != None
+                clients.append(('client_{}_{}'.format(f['server'], port), f['server'], port,
+                                'iperf3 -c {} -p {} {}'.format(f['server'], port, self.client_args)))
 
-    def stop_traffic(self, msg):
-        if self._proc and not self._proc.poll():
+        # iperf3 does not handle io buffering correctly, but it does seem to when --verbose
+        # is given. If we leave this out, we will frequently not capture all lines in the log
+        # file. 
+        if self.stream_metrics:
+            opts = ' --verbose --json-stream'
+        else:
+            opts = ' --verbose' + (' -J' if self.json else '')
+
+        return ([(n, s, p, c + opts) for n, s, p, c in servers],
+                [(n, s, p, c + opts) for n, s, p, c in clients])
+
+    def _launch(self, name, cmd, server, port):
+        '''Start an iperf3 process. Returns its Popen and the thread reading its --json-stream output (or None).'''
+        logfd = self._get_logfd(name)
+        proc = self._supervisor.start(name, cmd, stdout=PIPE if self.stream_metrics else logfd)
+        if not proc:
+            return None, None
+
+        t = None
+
+        if self.stream_metrics:
+            meta = {
+                'flow': name,
+                'role': 'server' if server is None else 'client',
+                'server': testbed.nodename if server is None else server,
+                'port': port
+            }
+            t = threading.Thread(target=self._ingest, args=(proc.stdout, logfd, meta))
+            t.daemon = True
+            t.start()
+            self._readers.append(t)
+
+        return proc, t
+
+    def _configure_database(self):
+        if self._sink:
+            return
+
+        # self.name does not exist in __init__().
+        self._sink = MetricsSink(database.getCollection(self.name), self.metric_period)
+        dashboard = DeterDashboard()
+        units = [
+            {'data_key': 'throughput', 'display': 'Throughput', 'unit': 'bits/sec'},
+            {'data_key': 'retransmits', 'display': 'Retransmits', 'unit': 'segments'},
+            {'data_key': 'rtt', 'display': 'RTT', 'unit': 'ms'},
+            {'data_key': 'cwnd', 'display': 'Congestion Window', 'unit': 'bytes'}
+        ]
+        dashboard.add_time_plot('Iperf', self.name, 'host', units)
+
+    def _ingest(self, pipe, logfd, meta):
+        '''Log each --json-stream line of an iperf3 process and buffer a metric per interval.'''
+        for line in iter(pipe.readline, ''):
+            logfd.write(line)
             try:
-                log.info('killing iperf3')
-                self._proc.kill()
-            except OSError:
-                pass   # meh.
-
-        self._clear_logfd()
-        self._proc = None
-
-        # Just to be safe. 
-        try:
-            log.info('pkilling iperf3')
-            call('pkill iperf3'.split(), shell=True)
-        except CalledProcessError as e:
-            log.info('error pkilling iperf: {}'.format(e))
-            pass
+                event = json.loads(line)
+            except ValueError:
+                continue    # --verbose text.
+
+            if event.get('event') == 'interval':
+                doc = interval_metrics(event.get('data', {}))
+                if doc:
+                    doc.update(meta)
+                    self._sink.add(doc)
+            elif event.get('event') == 'error':
+                log.error('iperf {}: {}'.format(meta['flow'], event.get('data')))
+
+        pipe.close()
+
+    @staticmethod
+    def _listening_ports():
+        '''The local TCP ports in the LISTEN state.'''
+        ports = set()
+        for path in ['/proc/net/tcp', '/proc/net/tcp6']:
+            try:
+                with open(path) as fd:
+                    next(fd)
+                    for line in fd:
+                        fields = line.split()
+                        if fields[3] == '0A':
+                            ports.add(int(fields[1].rsplit(':', 1)[1], 16))
+            except (IOError, OSError, StopIteration):
+                pass
+
+        return ports
+
+    def _wait_for_servers(self, servers, deadline):
+        '''Wait until the local servers listen (or exit). Returns the names of those listening.'''
+        waiting = {port: name for name, _, port, _ in servers if self._supervisor.running(name)}
+        ready = []
+        delay = 0.005
+        while waiting and time() < deadline:
+            listening = self._listening_ports()
+            for port in [p for p in waiting if p in listening]:
+                ready.append(waiting.pop(port))
+
+            for port, name in waiting.items():
+                if not self._supervisor.running(name):
+                    log.error('iperf server {} exited with {}'.format(name, self._supervisor.wait(name, 0)))
+                    del waiting[port]
+
+            if waiting:
+                sleep(delay)
+                delay = min(delay * 2, 0.1)
+
+        for name in waiting.values():
+            log.error('iperf server {} not listening after {}s'.format(name, self.start_timeout))
+
+        return ready
+
+    def _start_client(self, name, server, port, cmd, deadline, started):
+        '''
+            Start the client, and start it again while it fails at once because
+            its server is not listening yet or is busy. We do not probe the
+            server's port ourselves: iperf3 takes any connection to it for a
+            test, so a probe would log an error on the server and could hold it.
+        '''
+        delay = 0.05
+        while True:
+            proc, reader = self._launch(name, cmd, server, port)
+            if not proc:
+                return
+
+            # a client that can not reach its server exits at once.
+            returncode = self._supervisor.wait(name, 0.5)
+            if self._supervisor.running(name) or returncode == 0:
+                started.append(name)    # running or, for a very short test, done.
+                return
 
+            if reader:
+                reader.join()
+
+            logfd = self._get_logfd(name)
+            logfd.flush()
+            with open(logfd.name) as fd:
+                output = fd.read()
+
+            if not ('unable to connect' in output or 'server is busy' in output) or time() + delay >= deadline:
+                log.error('iperf client {} exited with {}'.format(name, returncode))
+                return
+
+            # keep the log to the run that counts.
+            logfd.seek(0)
+            logfd.truncate()
+            sleep(delay)
+            delay = min(delay * 2, 0.5)
+
+    def start_traffic(self, msg):
+        '''
+            Start iperf everywhere. All the servers on this node are started at
+            once and are ready when they listen. Then every client is started
+            (concurrently) as soon as its server accepts connections.
+        '''
+        if self._supervisor.names():
+            log.info('Stopping older iperf3 processes.')
+            self.stop_traffic(msg)
+
+        servers, clients = self._my_flows()
+        deadline = time() + float(self.start_timeout)
+
+        if self.stream_metrics:
+            self._configure_database()
+            self._sink.start()
+
+        for name, _, port, cmd in servers:
+            self._launch(name, cmd, None, port)
+
+        ready = self._wait_for_servers(servers, deadline)
+
+        started = []    # list.append is atomic.
+        threads = []
+        for name, server, port, cmd in clients:
+            t = threading.Thread(target=self._start_client, args=(name, server, port, cmd, deadline, started))
+            t.daemon = True
+            t.start()
+            threads.append(t)
+
+        for t in threads:
+            t.join()
+
+        log.info('iperf started {}/{} servers and {}/{} clients'.format(
+            len(ready), len(servers), len(started), len(clients)))
+        return len(ready) == len(servers) and len(started) == len(clients)
+
+    def stop_traffic(self, msg):
+        # SIGINT lets iperf3 write its final report.
+        log.info('stopping iperf3')
+        self._supervisor.stop_all(term_signal=signal.SIGINT, timeout=float(self.stop_timeout))
+
+        for t in self._readers:
+            t.join()
+
+        self._readers = []
+        if self._sink:
+            self._sink.stop()
+
+        self._clear_logfds()
         return True
 
+def interval_metrics(data):
+    '''
+        The metrics of an iperf3 --json-stream interval: the sum over the flow's
+        streams, with RTT (in ms) averaged and cwnd summed across the streams.
+    '''
+    total = data.get('sum')
+    if not total:
+        return None
+
+    doc = {
+        'start': total.get('start'),
+        'end': total.get('end'),
+        'bytes': total.get('bytes'),
+        'throughput': total.get('bits_per_second'),
+        'omitted': total.get('omitted', False),
+    }
+    for key in ['retransmits', 'jitter_ms', 'lost_packets', 'packets', 'lost_percent']:
+        if key in total:
+            doc[key] = total[key]
+
+    streams = data.get('streams', [])
+    rtts = [s['rtt'] for s in streams if 'rtt' in s]
+    if rtts:
+        doc['rtt'] = float(sum(rtts)) / len(rtts) / 1000.0     # iperf3 gives microseconds.
+
+    cwnds = [s['snd_cwnd'] for s in streams if 'snd_cwnd' in s]
+    if cwnds:
+        doc['cwnd'] = sum(cwnds)
+
+    return doc
+
 def getAgent(**kwargs):
     agent = IperfAgent()
     if not agent.setConfiguration(None, **kwargs):
@@ -7,6 +7,7 @@ from magi.util import database
 from magi.testbed import testbed
 
 from subprocess import check_call, CalledProcessError, Popen, PIPE
+from process_supervisor import ProcessSupervisor, exit_trigger
 
 import logging
 
@@ -27,9 +28,11 @@ class IronAgent(DispatchAgent):
         self.exp_dir = None         # must be set and must be the IRON experiment name in the dist tarfile.
         self.node_map = None        # must be set and must be a dict from node role to (short) node name.
         self.iface_in_map = None    # must be set and must be short node name to ip address of "in" interface
+        self.restart = 'never'      # restart policy for bpf and udp_proxy: never, on-failure or always.
+        self.stop_timeout = 5.0     # seconds to wait after SIGINT before killing IRON components.
 
         # do not touch below here.
-        self._procs = {}
+        self._supervisor = ProcessSupervisor(exit_trigger(self, testbed.nodename))
         self._install_dir = '/iron/install'   # MAGI install script puts it here. 
         self._bin_dir = '{}/bin'.format(self._install_dir)
         self._log_dir = '{}/logs'.format(self._install_dir)
@@ -81,7 +84,7 @@ class IronAgent(DispatchAgent):
     def start_iron(self, msg):
         '''Start IRON components on the experiment node.'''
         # this code could be cleaner.
-        if 'bfp' in self._procs and self._procs['bpf']:
+        if self._supervisor.running('bpf'):
             log.warn('bpf already started, not restarting')
         else:
             log.info('Starting bpf')
@@ -92,10 +95,10 @@ class IronAgent(DispatchAgent):
                 log.info('Running bpf with config file {}'.format(self._cfgs['bpf']))
                 cmd += ' -c {}'.format(self._cfgs['bpf'])
 
-            log.info('Running cmd: {}'.format(cmd))
-            self._procs['bpf'] = Popen(cmd.split(), close_fds=True)
+            if not self._supervisor.start('bpf', cmd, restart=self.restart):
+                return False
 
-        if 'udp_proxy' in self._procs and self._procs['udp_proxy']:
+        if self._supervisor.running('udp_proxy'):
             log.warn('udp_proxy already running. Not restarting')
         else:
             log.info('Starting udp_proxy')
@@ -110,25 +113,15 @@ class IronAgent(DispatchAgent):
 
                 cmd += ' -I {}'.format(iface)
 
-            log.info('Running cmd: {}'.format(cmd))
-            self._procs['udp_proxy'] = Popen(cmd.split(), close_fds=True)
+            if not self._supervisor.start('udp_proxy', cmd, restart=self.restart):
+                return False
         
         return True
 
     def stop_iron(self, msg):
-        # Do we want to kill nicely and check exit values? Does iron support understandable exit values?
-        for name, proc in self._procs.iteritems():
-            log.info('Stopping {}'.format(name))
-            proc.kill()
-
-        self._procs = {}  # goodbye procs!
-
-        # Just to be safe. 
-        for proc in ['bpf', 'udp_proxy']:
-            try:
-                check_call('pkill -f {}'.format(proc).split())
-            except CalledProcessError:
-                pass
+        # Ask nicely, then kill. Exit values are reported as triggers.
+        for name, returncode in self._supervisor.stop_all(timeout=float(self.stop_timeout)).iteritems():
+            log.info('Stopped {}: {}'.format(name, returncode))
 
         return True
 
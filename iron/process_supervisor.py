@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+
+import logging
+import os
+import signal
+import threading
+import time
+
+from subprocess import Popen, STDOUT
+
+log = logging.getLogger(__name__)
+
+class _Process(object):
+    '''A supervised command and the state of its current run.'''
+    def __init__(self, name, cmd, logfile, stdout, restart, max_restarts, restart_delay):
+        self.name = name
+        self.cmd = cmd
+        self.logfile = logfile
+        self.stdout = stdout
+        self.restart = restart
+        self.max_restarts = max_restarts
+        self.restart_delay = restart_delay
+        self.restarts = 0
+        self.popen = None
+        self.logfd = None
+        self.returncode = None      # None if it is running or we could not learn how it exited.
+        self.reaped = False         # its current run has exited and been waited for.
+        self.stopping = False
+        self.restart_at = None      # when to restart it, if it is waiting to be.
+        self.exited = threading.Event()
+
+class ProcessSupervisor(object):
+    '''
+        Run commands as processes and watch them from a single reaper thread.
+
+        Each process leads its own process group, so stopping one signals
+        everything it started. A stop sends term_signal, waits up to timeout for
+        the process to exit and then sends SIGKILL. Processes which exit on their
+        own may be restarted, per their restart policy: 'never', 'on-failure' (a
+        non zero exit) or 'always'. on_exit(name, returncode, restarting) is
+        called (from the reaper thread) every time a process exits. returncode
+        is None if the exit status could not be learned, which counts as a
+        failure.
+
+        The reaper waits on each supervised pid with waitpid(WNOHANG) rather than
+        on SIGCHLD or waitpid(-1): agents run as threads in the MAGI daemon,
+        where a signal handler can not be installed and reaping any child would
+        take processes from other agents. It checks every poll seconds and is
+        woken at once when processes are started or stopped.
+    '''
+    policies = ['never', 'on-failure', 'always']
+
+    def __init__(self, on_exit=None, poll=0.05):
+        self.on_exit = on_exit
+        self.poll = poll
+        self._procs = {}    # name --> _Process
+        self._unreaped = [] # stopped processes that did not exit (yet); still to be reaped.
+        self._lock = threading.Lock()
+        self._reap_lock = threading.Lock()  # held to reap or to signal, so a reaped pid is never signalled.
+        self._wake = threading.Event()
+        self._thread = None
+
+    def start(self, name, cmd, logfile=None, stdout=None, restart='never', max_restarts=3,
+              restart_delay=1.0):
+        '''
+            Start cmd (a string or list) as name, with its output written to
+            the file logfile or to the file object stdout. Any process already
+            started as name is stopped first. Returns the Popen, or None if the
+            command could not be run.
+        '''
+        if restart not in self.policies:
+            raise ValueError('Unknown restart policy "{}", not one of {}'.format(restart, self.policies))
+
+        if name in self._procs:
+            self.stop(name)
+
+        proc = _Process(name, cmd.split() if isinstance(cmd, basestring) else cmd,
+                        logfile, stdout, restart, max_restarts, restart_delay)
+        if not self._spawn(proc):
+            return None
+
+        with self._lock:
+            self._procs[name] = proc
+
+        self._start_reaper()
+        return proc.popen
+
+    def _spawn(self, proc):
+        try:
+            if proc.logfile and not proc.logfd:
+                proc.logfd = open(proc.logfile, 'a' if proc.restarts else 'w')
+
+            log.info('running {}: "{}"'.format(proc.name, ' '.join(proc.cmd)))
+            proc.popen = Popen(proc.cmd, stdout=proc.logfd or proc.stdout, stderr=STDOUT,
+                               close_fds=True, preexec_fn=os.setsid)
+        except (OSError, IOError, ValueError) as e:
+            log.error('Unable to start {}: {}'.format(proc.name, e))
+            self._close_log(proc)
+            return False
+
+        proc.returncode = None
+        proc.reaped = False
+        proc.exited.clear()
+        return True
+
+    def _close_log(self, proc):
+        if proc.logfd:
+            proc.logfd.close()
+            proc.logfd = None
+
+    def _start_reaper(self):
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                self._wake.set()
+                return
+
+            self._thread = threading.Thread(target=self._reap)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _reap(self):
+        while True:
+            with self._lock:
+                procs = [p for p in self._procs.values() if not p.reaped or p.restart_at is not None]
+                procs += self._unreaped
+                if not procs:
+                    self._thread = None
+                    return
+
+            now = time.time()
+            for proc in procs:
+                if proc.restart_at is not None:
+                    if now >= proc.restart_at:
+                        self._restart(proc)
+                elif not proc.reaped:
+                    self._check(proc)
+
+            self._wake.wait(self.poll)
+            self._wake.clear()
+
+    def _check(self, proc):
+        with self._reap_lock:
+            try:
+                pid, status = os.waitpid(proc.popen.pid, os.WNOHANG)
+            except OSError:     # reaped by someone else, so we can not know how it exited.
+                pid, status = proc.popen.pid, None
+
+            if pid == 0:
+                return
+
+            proc.reaped = True
+
+        if status is None:
+            returncode = None
+        elif os.WIFSIGNALED(status):
+            returncode = -os.WTERMSIG(status)
+        else:
+            returncode = os.WEXITSTATUS(status)
+
+        proc.popen.returncode = returncode      # so poll() and wait() on the Popen work.
+        restarting = not proc.stopping and proc.restarts < proc.max_restarts and \
+            (proc.restart == 'always' or (proc.restart == 'on-failure' and returncode != 0))
+
+        log.info('{} (pid {}) exited with {}{}'.format(proc.name, proc.popen.pid, returncode,
+                                                       ', restarting' if restarting else ''))
+        if restarting:
+            proc.restart_at = time.time() + proc.restart_delay
+        else:
+            self._close_log(proc)
+
+        proc.returncode = returncode
+        proc.exited.set()
+        with self._lock:
+            if proc in self._unreaped:
+                self._unreaped.remove(proc)
+
+        if self.on_exit:
+            try:
+                self.on_exit(proc.name, returncode, restarting)
+            except Exception as e:
+                log.error('Error reporting exit of {}: {}'.format(proc.name, e))
+
+    def _restart(self, proc):
+        proc.restart_at = None
+        proc.restarts += 1
+        if not proc.stopping:
+            self._spawn(proc)
+
+    def running(self, name):
+        proc = self._procs.get(name)
+        return bool(proc and (not proc.reaped or proc.restart_at is not None))
+
+    def names(self):
+        '''The names of the processes started (and not stopped), running or not.'''
+        return self._procs.keys()
+
+    def wait(self, name, timeout=None):
+        '''
+            Wait up to timeout seconds (forever if None) for name to exit.
+            Returns its exit status, or None if it is still running (or how it
+            exited is not known).
+        '''
+        proc = self._procs.get(name)
+        if not proc:
+            return None
+
+        # Event.wait() with no timeout can not be interrupted in python 2.
+        deadline = None if timeout is None else time.time() + timeout
+        while not proc.exited.wait(1.0 if deadline is None else max(min(deadline - time.time(), 1.0), 0)):
+            if deadline is not None and time.time() >= deadline:
+                break
+
+        return proc.returncode
+
+    def _signal(self, proc, sig):
+        '''Signal proc's process group, unless proc has been reaped: its pid may belong to someone else by now.'''
+        with self._reap_lock:
+            if proc.popen is None or proc.reaped:
+                return
+
+            try:
+                os.killpg(proc.popen.pid, sig)
+            except OSError:
+                pass    # gone already.
+
+    def stop(self, name, term_signal=signal.SIGINT, timeout=5.0):
+        '''Stop name, escalating to SIGKILL after timeout. Returns its exit status.'''
+        return self.stop_all([name], term_signal, timeout).get(name)
+
+    def stop_all(self, names=None, term_signal=signal.SIGINT, timeout=5.0):
+        '''
+            Stop the named processes (default all) at once: signal all of them,
+            wait up to timeout for all of them, then SIGKILL what is left.
+            Returns the exit status of each.
+        '''
+        with self._lock:
+            if names is None:
+                names = self._procs.keys()
+
+            procs = [self._procs[n] for n in names if n in self._procs]
+            for proc in procs:
+                proc.stopping = True
+                proc.restart_at = None
+
+        for proc in procs:
+            self._signal(proc, term_signal)
+
+        self._wake.set()
+        deadline = time.time() + timeout
+        for proc in procs:
+            proc.exited.wait(max(deadline - time.time(), 0))
+
+        left = [proc for proc in procs if not proc.exited.is_set()]
+        for proc in left:
+            log.info('{} did not exit after {}s, killing it'.format(proc.name, timeout))
+            self._signal(proc, signal.SIGKILL)
+
+        self._wake.set()
+        for proc in left:
+            proc.exited.wait(max(self.poll * 20, 1.0))
+
+        statuses = {}
+        with self._lock:
+            for proc in procs:
+                self._close_log(proc)
+                statuses[proc.name] = proc.returncode
+                if self._procs.get(proc.name) is proc:
+                    del self._procs[proc.name]
+
+                if not proc.reaped:
+                    log.warning('{} (pid {}) has not exited yet.'.format(proc.name, proc.popen.pid))
+                    self._unreaped.append(proc)     # so the reaper still waits for it.
+
+        if [p for p in procs if not p.reaped]:
+            self._start_reaper()
+
+        return statuses
+
+def exit_trigger(agent, nodename, event='processExit'):
+    '''
+        An on_exit callback which sends a trigger from agent (via its messenger)
+        for each exit, so the orchestrator can wait on or react to them.
+    '''
+    def on_exit(name, returncode, restarting):
+        messenger = getattr(agent, 'messenger', None)
+        if messenger:
+            messenger.trigger(event=event, nodes=[nodename], agent=getattr(agent, 'name', None),
+                              process=name, returncode=returncode, restarting=restarting)
+
+    return on_exit
@@ -3,12 +3,11 @@
 import logging
 from os.path import isfile, join
 from os import access, R_OK
-from time import sleep
 
-from subprocess import Popen, STDOUT, CalledProcessError
 from magi.util.agent import ReportingDispatchAgent
 from magi.util.processAgent import initializeProcessAgent
 from magi.testbed import testbed
+from process_supervisor import ProcessSupervisor, exit_trigger
 
 log = logging.getLogger(__name__)
 
@@ -27,10 +26,11 @@ class mgen_agent(ReportingDispatchAgent):
         # If log is not specified, /tmp/mgen.log will be used. 
         self.log = None
         self.log_append = False
+        self.restart = 'never'      # restart policy: never, on-failure or always.
+        self.stop_timeout = 2.0     # seconds to wait after SIGINT before killing MGEN.
 
         # "private" below here.
-        self._proc = None
-        self._logfd = None
+        self._supervisor = ProcessSupervisor(exit_trigger(self, testbed.nodename))
 
     def get_config_path(self):
         return join(self.config_dir, '{}.mgen'.format(testbed.nodename))
@@ -56,59 +56,44 @@ class mgen_agent(ReportingDispatchAgent):
         return True
 
     def clean(self):
-        self._proc = None
-        if self._logfd:
-            self._logfd.close()
-        self._logfd = None
+        self._supervisor.stop_all(timeout=float(self.stop_timeout))
 
     def start(self, msg):
         '''Start the MGEN process with the given configuration file. Restart the process if it's running.'''
-        if self._proc:
-            self.stop()
+        if self._supervisor.running('mgen'):
+            self.stop(msg)
 
-        self._logfd = open(self.log, 'w')
-        if not self._logfd:
-            log.critical('Unable to open MGEN log file {}. Unable to continue.'.format(self._logfd))
+        cfg = self.get_config_path()
+        if not self._supervisor.start('mgen', 'mgen input {}'.format(cfg), logfile=self.log,
+                                      restart=self.restart):
+            log.critical('Error running MGEN. Unable to continue.')
             return False
 
-        try:
-            cfg = self.get_config_path()
-            self._proc = Popen('mgen input {}'.format(cfg).split(), stdout=self._logfd,
-                               stderr=STDOUT, close_fds=True)
-        except (CalledProcessError, OSError) as e:
-            log.critical('Error running MGEN: {}'.format(e))
+        # check for immediate failure.
+        returncode = self._supervisor.wait('mgen', 0.5)
+        if returncode or (returncode is None and not self._supervisor.running('mgen')):
+            log.critical('MGEN failed to start on node {}. Exit val: {}. Check the log at {}:{}'.format(
+                testbed.nodename, returncode, testbed.nodename, self.log))
             self.clean()
             return False
 
-        # check for immediate failure.
-        sleep(0.5)  # GTL - blech
-        if self._proc.poll():
-            if self._proc.returncode != 0:
-                log.critical('MGEN failed to start on node {}. Exit val: {}. Check the log at {}:{}'.format(
-                    testbed.nodename, self._proc.returncode, testbed.nodename, self.log))
-                self.clean()
-                return False
-
         # Looks good.
         return True
 
     def stop(self, msg):
         '''Stop the MGEN process if it's running.'''
-        if self._proc:
-            log.debug('Killing running MGEN process ({})'.format(self._proc.pid))
-            self._proc.kill()
-        
+        log.debug('Stopping MGEN')
         self.clean()
         return True
 
     def periodic(self, now):
         log.debug('Checking for end of mgen process.')
-        if self._proc:
-            if self._proc.poll() is not None:  # process complete.
+        if self._supervisor.names():
+            if not self._supervisor.running('mgen'):  # process complete.
                 log.info('MGEN process complete. Cleaning up.')
                 self.clean()
             else:
-                log.debug('MGEN still running: {}'.format(self._proc))
+                log.debug('MGEN still running.')
         else:
             log.debug('MGEN not running.')
 
@@ -80,7 +80,7 @@ class CounterRecorder(ReportingDispatchAgent):
                 (trafficDirection, intfName) = name.split('-')
                 self.collection.insert(
                     {"intfName": intfName,
-                     "peerNode": self.intf2NodeMap[intfName],
+                     "peerNode": self.intf2NodeMap.get(intfName, 'peerNode'),
                      "trafficDirection": trafficDirection,
                      "packets": pkts,
                      "bytes": bytes})
@@ -150,6 +150,7 @@ class CounterRecorder(ReportingDispatchAgent):
 
     def populateIntf2Node(self):
         self.intf2NodeMap = dict()
+        self.ip2NodeMap = self.buildTopoIndex()
         for intf in testbed.getInterfaceList():
             try:
                 peerNode = self.intf2Node(intf.name)
@@ -162,6 +163,29 @@ class CounterRecorder(ReportingDispatchAgent):
                 peerNode = 'peerNode'
             self.intf2NodeMap[intf.name] = peerNode
 
+    def buildTopoIndex(self):
+        """ Walk the topology graph once and return a map of local link ip to
+        the neighbor at the other end of that link. """
+        ip2Node = dict()
+        try:
+            topoGraph = testbed.getTopoGraph()
+            src = testbed.getNodeName()
+            linkName2Node = dict()
+            # sorted so that the first neighbor wins, as in the old per
+            # interface lookup.
+            for neighbor in sorted(topoGraph.neighbors(src)):
+                linkName = topoGraph[src][neighbor].get('linkName')
+                if linkName and linkName not in linkName2Node:
+                    linkName2Node[linkName] = neighbor
+
+            for link in topoGraph.node[src]['links'].values():
+                if link['name'] in linkName2Node and link['ip'] not in ip2Node:
+                    ip2Node[link['ip']] = linkName2Node[link['name']]
+        except Exception:
+            log.error("Unable to build topology index", exc_info=1)
+
+        return ip2Node
+
     def intf2Node(self, intf):
         try:
             ip = testbed.getInterfaceInfo(matchname=intf).ip
@@ -170,28 +194,18 @@ class CounterRecorder(ReportingDispatchAgent):
                 "No information available for interface. Mostly invalid interface. Interface Name: %s" %
                 (intf))
 
-        topoGraph = testbed.getTopoGraph()
-        src = testbed.getNodeName()
-
-        for link in topoGraph.node[src]['links'].values():
-            if ip == link['ip']:
-                linkName = link['name']
-                break
-
-        if not linkName:
+        if ip not in self.ip2NodeMap:
             raise Exception(
                 "No information available for interface. Mostly invalid interface. Interface Name: %s" %
                 (intf))
 
-        neighbors = topoGraph.neighbors(src)
-        neighbors.sort()
-        for neighbor in neighbors:
-            if linkName == topoGraph[src][neighbor]['linkName']:
-                return neighbor
+        return self.ip2NodeMap[ip]
 
-        raise Exception(
-            "No information available for interface. Mostly invalid interface. Interface Name: %s" %
-            (intf))
+    @agentmethod()
+    def refreshIntf2Node(self, msg):
+        """ Rebuild the interface to peer node map, e.g. after interfaces change """
+        self.populateIntf2Node()
+        return True
 
     @agentmethod()
     def startCollection(self, msg):
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+
+import math
+import threading
+import time
+
+class LatencyHistogram(object):
+    '''
+        An HDR style histogram of latencies in microseconds. Each power of two
+        range is split into 2**sub_bucket_bits linear buckets, so any recorded
+        value is within 1/2**sub_bucket_bits of its bucket no matter how large
+        it is, and the histogram stays small. Buckets are kept sparse.
+    '''
+    def __init__(self, sub_bucket_bits=4):
+        self.sub_bucket_bits = sub_bucket_bits
+        self._sub_buckets = 1 << sub_bucket_bits
+        self.counts = {}    # bucket index --> count
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def _index(self, value):
+        shift = value.bit_length() - (self.sub_bucket_bits + 1)
+        if shift <= 0:
+            return value
+
+        return shift * self._sub_buckets + (value >> shift)
+
+    def _value(self, index):
+        '''The middle of the range of values in bucket index.'''
+        if index < 2 * self._sub_buckets:
+            return index
+
+        shift = index // self._sub_buckets - 1
+        mantissa = index - shift * self._sub_buckets
+        return (mantissa << shift) + (1 << (shift - 1))
+
+    def record(self, seconds):
+        value = max(int(seconds * 1000000), 0)
+        index = self._index(value)
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def percentile(self, pct):
+        '''The value (in microseconds) at the given percentile.'''
+        if not self.count:
+            return 0
+
+        rank = max(int(math.ceil(pct / 100.0 * self.count)), 1)
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= rank:
+                return min(max(self._value(index), self.min), self.max)
+
+        return self.max
+
+    def buckets(self):
+        '''The non empty buckets as a sorted list of [index, count].'''
+        return [[index, self.counts[index]] for index in sorted(self.counts)]
+
+class LatencyHistograms(object):
+    '''
+        Per server, per metric latency histograms for the current period. Once
+        the period is over, publish() hands one compact document per server to
+        the given publish function and starts new histograms.
+    '''
+    percentiles = [('p50', 50), ('p90', 90), ('p99', 99), ('p999', 99.9)]
+
+    def __init__(self, metrics, period=1.0, sub_bucket_bits=4):
+        self.metrics = metrics
+        self.period = period
+        self.sub_bucket_bits = sub_bucket_bits
+        self._histograms = {}   # server --> metric --> LatencyHistogram
+        self._start = time.time()
+        self._lock = threading.Lock()
+
+    def record(self, server, values):
+        '''Record the latencies (in seconds) given in values, a dict keyed by metric.'''
+        with self._lock:
+            histograms = self._histograms.get(server)
+            if histograms is None:
+                histograms = {m: LatencyHistogram(self.sub_bucket_bits) for m in self.metrics}
+                self._histograms[server] = histograms
+
+            for metric in self.metrics:
+                if metric in values:
+                    histograms[metric].record(values[metric])
+
+    def due(self):
+        return time.time() - self._start >= self.period
+
+    def publish(self, publish):
+        '''Call publish with a document per server for the period so far and reset.'''
+        with self._lock:
+            now = time.time()
+            histograms, self._histograms = self._histograms, {}
+            interval, self._start = now - self._start, now
+
+        for server, metrics in histograms.iteritems():
+            doc = {
+                'server': server,
+                'interval': interval,
+                'unit': 'us',
+                'sub_bucket_bits': self.sub_bucket_bits,
+                'histograms': {}
+            }
+            for metric, histogram in metrics.iteritems():
+                if not histogram.count:
+                    continue
+
+                doc[metric + '_count'] = histogram.count
+                doc[metric + '_min'] = histogram.min
+                doc[metric + '_max'] = histogram.max
+                doc[metric + '_mean'] = histogram.total / histogram.count
+                for name, pct in self.percentiles:
+                    doc[metric + '_' + name] = histogram.percentile(pct)
+
+                doc['histograms'][metric] = histogram.buckets()
+
+            publish(doc)
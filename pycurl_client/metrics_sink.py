@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+
+import logging
+import threading
+import time
+
+from collections import deque
+
+log = logging.getLogger(__name__)
+
+class MetricsSink(object):
+    '''
+        Buffer metric documents in memory and batch insert them into a database
+        collection from a background thread. The buffer is flushed every period
+        seconds, or sooner once batch_size documents are waiting.
+
+        add() only appends to the buffer (a deque append is atomic), so it is
+        cheap enough to call from inside curl callbacks and never waits on the
+        database. The buffer holds at most maxlen documents; when it is full new
+        documents are dropped and counted in dropped rather than blocking.
+    '''
+    def __init__(self, collection, period=1.0, maxlen=10000, batch_size=500):
+        self._collection = collection
+        self._period = period
+        self._maxlen = maxlen
+        self._batch_size = batch_size
+        self._buffer = deque()
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._thread = None
+        self._drop_lock = threading.Lock()
+        self._reported_dropped = 0
+        self.dropped = 0
+
+    def add(self, doc):
+        '''Buffer doc for insertion. Returns False if the buffer is full and doc was dropped.'''
+        if len(self._buffer) >= self._maxlen:
+            with self._drop_lock:
+                self.dropped += 1
+            return False
+
+        # when it happened. 'created' is left to the database, which stamps it on insert.
+        if 'sampled_at' not in doc:
+            doc['sampled_at'] = time.time()
+
+        self._buffer.append(doc)
+        if len(self._buffer) >= self._batch_size:
+            self._wake.set()
+
+        return True
+
+    def start(self):
+        if self._thread:
+            return
+
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        '''Stop the flusher thread and write whatever is still buffered.'''
+        if self._thread:
+            self._stop.set()
+            self._wake.set()
+            self._thread.join()
+            self._thread = None
+
+        self.flush()
+
+    def flush(self):
+        docs = []
+        while True:
+            try:
+                docs.append(self._buffer.popleft())
+            except IndexError:
+                break
+
+        for i in range(0, len(docs), self._batch_size):
+            batch = docs[i:i+self._batch_size]
+            try:
+                self._collection.insert(batch)
+            except Exception as e:
+                log.error('Unable to insert {} metrics: {}'.format(len(batch), e))
+
+        if self.dropped != self._reported_dropped:
+            log.warning('Metrics buffer full, dropped {} metrics so far.'.format(self.dropped))
+            self._reported_dropped = self.dropped
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(self._period)
+            self._wake.clear()
+            self.flush()
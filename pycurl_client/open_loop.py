@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+
+import logging
+import threading
+import time
+import Queue
+
+log = logging.getLogger(__name__)
+
+class OpenLoopScheduler(object):
+    '''
+        Issue requests at the times given by an interval distribution, no matter
+        how many earlier requests are still outstanding. Requests are run by a
+        bounded pool of worker threads. If all workers are busy, requests wait in
+        a bounded queue (and are dropped and counted if it is full) so the time
+        a request waited to start, the queueing delay, shows the lag between the
+        offered and the achieved load.
+
+        request is called with no arguments to make one request. interval is an
+        object with a sample() method giving the next inter-request time in
+        seconds. report, if given, is called every report_period seconds with a
+        dict of scheduling statistics. abort, if given, is called by stop() to
+        cut short the requests in progress, so stopping does not wait for them.
+    '''
+    def __init__(self, request, interval, workers=16, max_queue=1000, report=None, report_period=1.0,
+                 abort=None):
+        self.request = request
+        self.interval = interval
+        self.workers = workers
+        self.report = report
+        self.report_period = report_period
+        self.abort = abort
+
+        self._queue = Queue.Queue(maxsize=max_queue)
+        self._stop = threading.Event()
+        self._threads = []
+        self._lock = threading.Lock()
+        self._reset_stats(time.time())
+
+    def start(self):
+        if self._threads:
+            return
+
+        self._stop.clear()
+        self._reset_stats(time.time())
+        self._threads = [threading.Thread(target=self._schedule)]
+        self._threads += [threading.Thread(target=self._work) for _ in range(self.workers)]
+        for t in self._threads:
+            t.daemon = True
+            t.start()
+
+    def stop(self, timeout=2.0):
+        '''
+            Stop scheduling, abort the requests in progress and wait up to
+            timeout seconds for the workers. Workers still stuck in a request
+            are left to finish it on their own; they start no more requests.
+        '''
+        self._stop.set()
+        if self.abort:
+            try:
+                self.abort()
+            except Exception:
+                log.error('Error aborting requests', exc_info=1)
+
+        deadline = time.time() + timeout
+        for t in self._threads:
+            t.join(max(deadline - time.time(), 0))
+
+        busy = sum(1 for t in self._threads if t.is_alive())
+        if busy:
+            log.warning('{} requests still running after {}s, not waiting for them.'.format(busy, timeout))
+
+        self._threads = []
+
+        # anything still queued was never started.
+        while True:
+            try:
+                self._queue.get_nowait()
+            except Queue.Empty:
+                break
+
+    def _reset_stats(self, now):
+        self._period_start = now
+        self._scheduled = 0
+        self._started = 0
+        self._completed = 0
+        self._dropped = 0
+        self._delay_sum = 0.0
+        self._delay_max = 0.0
+
+    def _schedule(self):
+        next_request = time.time()
+        next_report = next_request + self.report_period
+        while not self._stop.is_set():
+            now = time.time()
+            if now >= next_report:
+                self._report(now)
+                next_report += self.report_period
+
+            if now < next_request:
+                self._stop.wait(min(next_request, next_report)-now)
+                continue
+
+            with self._lock:
+                self._scheduled += 1
+
+            try:
+                self._queue.put_nowait(next_request)
+            except Queue.Full:
+                with self._lock:
+                    self._dropped += 1
+
+            # keep to the schedule rather than to when we got here.
+            next_request += float(self.interval.sample())
+
+    def _work(self):
+        while not self._stop.is_set():
+            try:
+                scheduled = self._queue.get(timeout=0.5)
+            except Queue.Empty:
+                continue
+
+            delay = time.time()-scheduled
+            with self._lock:
+                self._started += 1
+                self._delay_sum += delay
+                self._delay_max = max(self._delay_max, delay)
+
+            try:
+                self.request()
+            except Exception:
+                log.error('Error making request', exc_info=1)
+
+            with self._lock:
+                self._completed += 1
+
+    def _report(self, now):
+        with self._lock:
+            period = now-self._period_start
+            stats = {
+                'scheduled': self._scheduled,
+                'started': self._started,
+                'completed': self._completed,
+                'dropped': self._dropped,
+                'queued': self._queue.qsize(),
+                'scheduled_rate': self._scheduled/period if period > 0 else 0.0,
+                'achieved_rate': self._started/period if period > 0 else 0.0,
+                'mean_queueing_delay': self._delay_sum/self._started if self._started else 0.0,
+                'max_queueing_delay': self._delay_max
+            }
+            self._reset_stats(now)
+
+        log.debug('open loop stats: {}'.format(stats))
+        if self.report:
+            try:
+                self.report(stats)
+            except Exception:
+                log.error('Error reporting open loop stats', exc_info=1)
@@ -12,16 +12,36 @@ import logging
 import random
 import sys
 import socket
+import threading
+import Queue
 
 from magi.util.distributions import *
-from magi.util.agent import TrafficClientAgent
+from magi.util.agent import TrafficClientAgent, agentmethod
 from magi.util.processAgent import initializeProcessAgent
 from magi.util import database
 from magi.util.execl import execAndRead
 from libdeterdash import DeterDashboard
+from metrics_sink import MetricsSink
+from open_loop import OpenLoopScheduler
+from latency_histogram import LatencyHistograms
+from distribution_sampler import DistributionSampler
 
 log = logging.getLogger(__name__)
 
+class _Transfer(object):
+    '''
+        A (reusable) curl easy handle and the state of the transfer it is running.
+    '''
+    def __init__(self):
+        self.curl = pycurl.Curl()
+        self.reset(None)
+
+    def reset(self, dst):
+        self.dst = dst
+        self.prev_time = time.time()  # seed the time for the progress callback.
+        self.prev_bytes = 0
+        self.progress_interval = 0.0
+
 class PyCurlAgent(TrafficClientAgent):
     """
         This agent uses the pycurl module to retrieve data via HTTP. It writes
@@ -32,6 +52,7 @@ class PyCurlAgent(TrafficClientAgent):
 
         # Can be support distribution function (look magi.util.distributions)
         self.sizes = '1000'
+        self._sizes = None   # DistributionSampler for sizes.
 
         # bind to specific local port
         self.localPort = None
@@ -48,14 +69,58 @@ class PyCurlAgent(TrafficClientAgent):
         # database. Should probably be kept at 1.0. 
         self.metric_period = 1.0
 
+        # If greater than 0, run transfers on a CurlMulti engine with at most this
+        # many transfers in flight, reusing a pool of easy handles. Each interval
+        # starts a new transfer. If saturate is True, the engine instead keeps
+        # concurrency transfers in flight at all times.
+        self.concurrency = 0
+        self.saturate = False
+
+        # If True, keep connections open (HTTP keep-alive) and reuse them for later
+        # requests to the same server instead of paying for a new connection
+        # each time. max_host_connections limits the connections kept per server
+        # (0 is no limit). pipelining allows HTTP pipelining on the CurlMulti engine.
+        self.reuse_connections = False
+        self.max_host_connections = 0
+        self.pipelining = False
+        self.tcp_keepalive = False
+
+        # If True, start requests at the times given by interval whether or not
+        # earlier requests have finished (open loop) using up to workers
+        # concurrent requests, rather than waiting for each request to finish
+        # before scheduling the next (closed loop).
+        self.open_loop = False
+        self.workers = 16
+
+        # at most this many metrics are buffered in memory waiting to be written
+        # to the database. Past that, metrics are dropped (and counted).
+        self.max_buffered_metrics = 10000
+
+        # If True, keep per server latency histograms and write a summary of
+        # them (with percentiles) to <name>_latency every metric_period. If
+        # per_request_metrics is False, only the summaries are written.
+        self.latency_histograms = False
+        self.per_request_metrics = True
+
         # internal vars below here.
         self._db_configured = False
-        self._prev_time = time.time()
-        self._prev_bytes = 0
+        self._engine = None     # CurlMulti engine thread.
+        self._engine_running = False
+        self._pending = None    # Queue of transfers waiting for the engine.
+        self._idle = {}         # server --> list of idle transfers with open connections.
+        self._idle_lock = threading.Lock()
         self._collection = None
         self._collection_progress = None
         self._collection_error = None
-        self._progress_interval = 0
+        self._sink = None            # batches post transfer metrics into the database.
+        self._error_sink = None
+        self._progress_sink = None   # buffers progress samples for batch insertion.
+        self._collection_schedule = None
+        self._scheduler = None
+        self._aborting = False  # set to make the transfers in progress give up.
+        self._sizes_lock = threading.Lock()  # open loop workers sample sizes concurrently.
+        self._latency_sink = None
+        self._histograms = None
         self._url = "http://{}/gettext/{}"
 
     def _configure_database(self):
@@ -66,6 +131,20 @@ class PyCurlAgent(TrafficClientAgent):
         self._collection = database.getCollection(self.name)
         self._collection_progress = database.getCollection(self.name + '_progress')
         self._collection_error = database.getCollection(self.name + '_error')
+        self._collection_schedule = database.getCollection(self.name + '_schedule')
+        maxlen = int(self.max_buffered_metrics)
+        self._sink = MetricsSink(self._collection, self.metric_period, maxlen)
+        self._error_sink = MetricsSink(self._collection_error, self.metric_period, maxlen)
+        self._progress_sink = MetricsSink(self._collection_progress, self.metric_period, maxlen)
+        for sink in [self._sink, self._error_sink, self._progress_sink]:
+            sink.start()
+
+        if self.latency_histograms:
+            self._histograms = LatencyHistograms(
+                ['connect_time', 'start_transfer_time', 'total_time'], self.metric_period)
+            self._latency_sink = MetricsSink(database.getCollection(self.name + '_latency'),
+                                             self.metric_period, maxlen)
+            self._latency_sink.start()
 
         # set up visualization server to show our metrics.
         # we do this here as self.name exists here but not in __init__()
@@ -73,17 +152,23 @@ class PyCurlAgent(TrafficClientAgent):
         units = [
             {'data_key': 'total_time', 'display': 'Total Time', 'unit': 'ms'},
             {'data_key': 'size', 'display': 'Transfer Size', 'unit': 'bytes'},
-            {'data_key': 'speed', 'display': 'Throughput', 'unit': 'bytes/sec'}
+            {'data_key': 'speed', 'display': 'Throughput', 'unit': 'bytes/sec'},
+            {'data_key': 'num_connects', 'display': 'New Connections', 'unit': 'connections'}
         ]
         dashboard.add_time_plot('PyCurl Client', self.name, 'host', units)
 
         units = [{'data_key': 'dl_interval', 'display': 'Throughput', 'unit': 'bytes/sec'}]
         dashboard.add_time_plot('PyCurl', self.name + '_progress', 'host', units)
 
+        if self.latency_histograms:
+            units = [{'data_key': 'total_time_' + p, 'display': 'Total Time ' + p, 'unit': 'us'}
+                     for p in ['p50', 'p99', 'p999']]
+            dashboard.add_time_plot('PyCurl Latency', self.name + '_latency', 'host', units)
+
         self._db_configured = True
 
     def _save_post_metrics(self, dst, c):  # c==pycurl instance.
-        self._collection.insert({
+        self._sink.add({
             # protocol checkpoint times in order
             # see: http://curl.haxx.se/libcurl/c/curl_easy_getinfo.html
             'name_lookup_time': c.getinfo(c.NAMELOOKUP_TIME),
@@ -107,7 +192,7 @@ class PyCurlAgent(TrafficClientAgent):
     def _save_progress_metrics(self, interval, dl_interval, dl_sofar, dl_total, ul_sofar, ul_total):
         # log.info('prog metrics: {}/{}/{}/{}/{}/{}'.format(
         #     interval, dl_interval, dl_sofar, dl_total, ul_sofar, ul_total))
-        self._collection_progress.insert({
+        self._progress_sink.add({
             'interval': interval,
             'dl_interval': dl_interval,
             'dl_sofar': dl_sofar,
@@ -116,43 +201,36 @@ class PyCurlAgent(TrafficClientAgent):
             'ul_total': ul_total
         })
 
-    def _progress_callback(self, dl_total, dl_sofar, ul_total, ul_sofar):
+    def _progress_callback(self, transfer, dl_total, dl_sofar, ul_total, ul_sofar):
         # this function is invoked by pycurl many many times a second
-        # during a connection. We may want to do as little computationally
-        # expensive stuff here as possible. We may want to write results to
-        # a queue, which is then evaluated once a second. 
+        # during a connection, so do as little as possible here. Samples
+        # only go into the progress sink's ring buffer and are written to
+        # the database from its thread, so the transfer never waits on it.
         now = time.time()    
-        self._progress_interval += now-self._prev_time
-        if self._progress_interval >= self.metric_period:
-            dl_interval = dl_sofar-self._prev_bytes
-            self._save_progress_metrics(self._progress_interval, dl_interval, dl_sofar,
+        transfer.progress_interval += now-transfer.prev_time
+        if transfer.progress_interval >= self.metric_period:
+            dl_interval = dl_sofar-transfer.prev_bytes
+            self._save_progress_metrics(transfer.progress_interval, dl_interval, dl_sofar,
                                         dl_total, ul_sofar, ul_total)
-            self._progress_interval = 0.0
-            self._prev_bytes = dl_sofar
+            transfer.progress_interval = 0.0
+            transfer.prev_bytes = dl_sofar
 
-        self._prev_time = now
+        transfer.prev_time = now
+        if self._aborting:
+            return 1  # makes curl give up on the transfer.
         return 0  # everything is OK.
 
-    def oneClient(self):
-        """ 
-            Called when the next client should fire (after interval time) 
-            We "overload" it here so we can write the results to our collection 
-            as the base class does not give us access to the command output.
-        """
-        if not self._db_configured:
-            self._configure_database()
-
-        if len(self.servers) < 1:
-            log.warning("no servers to contact, nothing to do")
-            return
-
-        dst = self.servers[random.randint(0, len(self.servers) - 1)]
-        c = pycurl.Curl()
-        url = self._url.format(dst, int(eval(self.sizes)))
+    def _setup_transfer(self, transfer, dst):
+        '''Point the transfer's handle at a new request to dst.'''
+        transfer.reset(dst)
+        c = transfer.curl
+        url = self._url.format(dst, int(self._size_sampler().sample()))
         log.info('curl url: {}'.format(url))
         c.setopt(c.URL, url)
         c.setopt(c.NOPROGRESS, 0)
-        c.setopt(c.PROGRESSFUNCTION, self._progress_callback)
+        # XFERINFOFUNCTION (libcurl 7.32+) passes integer counters rather than doubles.
+        c.setopt(c.XFERINFOFUNCTION if hasattr(c, 'XFERINFOFUNCTION') else c.PROGRESSFUNCTION,
+                 lambda dl_t, dl_s, ul_t, ul_s: self._progress_callback(transfer, dl_t, dl_s, ul_t, ul_s))
         c.setopt(c.WRITEFUNCTION, lambda s: None) # Do nothing with received data.
         c.setopt(c.FOLLOWLOCATION, True)   # do we want this? Shouldn't come up in current setup.
         if self.localPort:
@@ -161,6 +239,14 @@ class PyCurlAgent(TrafficClientAgent):
         if self.rateLimit:
             c.setopt(c.MAX_RECV_SPEED_LARGE, self.rateLimit)
 
+        if not self.reuse_connections:
+            # one connection per request, even if the handle is reused.
+            c.setopt(c.FRESH_CONNECT, 1)
+            c.setopt(c.FORBID_REUSE, 1)
+
+        if self.tcp_keepalive:
+            c.setopt(c.TCP_KEEPALIVE, 1)
+
         if self.useSocks:
             c.setopt(c.PROXY, '')
             c.setopt(c.PROXYPORT, self.socksPort)
@@ -170,45 +256,269 @@ class PyCurlAgent(TrafficClientAgent):
             else:
                 c.setopt(c.PROXYTYPE, c.PROXYTYPE_SOCKS5)
 
-        self._prev_time = time.time() # seed the time for the callback function.
-        self._prev_bytes = 0
-        try:
-            c.perform()
-        except pycurl.error as e:
-            log.error('Error running pycurl: {}'.format(e))
-            self._collection_error.insert({'exception': str(e)})
-            c.close()
-            return
-
+    def _transfer_done(self, transfer):
+        c = transfer.curl
         if c.getinfo(c.RESPONSE_CODE) != 200:
             log.error('Error with pycurl connection. Got response info/code: {} {}'.format(
                 c.getinfo(c.RESPONSE_CODE),
                 c.RESPONSE_CODE))
 
-        if self._collection:
-            self._save_post_metrics(dst, c)
+        if self._histograms:
+            self._histograms.record(transfer.dst, {
+                'connect_time': c.getinfo(c.CONNECT_TIME),
+                'start_transfer_time': c.getinfo(c.STARTTRANSFER_TIME),
+                'total_time': c.getinfo(c.TOTAL_TIME)
+            })
+            if self._histograms.due():
+                self._histograms.publish(self._latency_sink.add)
+
+        if self._collection and self.per_request_metrics:
+            self._save_post_metrics(transfer.dst, c)
+
+    def _transfer_error(self, transfer, error):
+        log.error('Error running pycurl: {}'.format(error))
+        self._error_sink.add({'exception': str(error)})
+
+    def _choose_server(self):
+        return self.servers[random.randint(0, len(self.servers) - 1)]
+
+    def _checkout_transfer(self, dst):
+        '''Get an idle transfer (and its open connection) to dst or a new one.'''
+        with self._idle_lock:
+            idle = self._idle.get(dst)
+            if idle:
+                transfer = idle.pop()
+                transfer.curl.reset()
+                return transfer
+
+        return _Transfer()
+
+    def _checkin_transfer(self, transfer):
+        '''Keep the transfer for reuse if we are reusing connections, else close it.'''
+        if self.reuse_connections:
+            with self._idle_lock:
+                idle = self._idle.setdefault(transfer.dst, [])
+                if not self.max_host_connections or len(idle) < self.max_host_connections:
+                    idle.append(transfer)
+                    return
+
+        transfer.curl.close()
+
+    def _close_idle(self):
+        with self._idle_lock:
+            for idle in self._idle.values():
+                for transfer in idle:
+                    transfer.curl.close()
+
+            self._idle = {}
+
+    def _start_engine(self):
+        self._pending = Queue.Queue(maxsize=self.concurrency)
+        self._engine_running = True
+        self._engine = threading.Thread(target=self._multi_loop)
+        self._engine.daemon = True
+        self._engine.start()
+
+    def _stop_engine(self):
+        self._engine_running = False
+        if self._engine:
+            self._engine.join()
+            self._engine = None
+
+    def _multi_loop(self):
+        '''
+            Drive all transfers from a single CurlMulti handle. New transfers are
+            taken from the pending queue (or started immediately if saturating) 
+            whenever there is a free easy handle. A failure handling one transfer
+            is logged and its handle reused; if the loop itself fails, the engine
+            is marked stopped so the next oneClient() starts a new one.
+        '''
+        multi = pycurl.CurlMulti()
+        free = [_Transfer() for _ in range(self.concurrency)]
+        active = {}   # easy handle --> transfer
+        try:
+            if self.pipelining:
+                multi.setopt(pycurl.M_PIPELINING, 1)
+
+            if self.max_host_connections:
+                multi.setopt(pycurl.M_MAX_HOST_CONNECTIONS, self.max_host_connections)
+
+            while self._engine_running:
+                setup_failed = False
+                while free:
+                    if not self.saturate:
+                        try:
+                            # only wait for work if there is nothing else to do.
+                            self._pending.get(block=not active, timeout=0.1)
+                        except Queue.Empty:
+                            break
+
+                    transfer = free.pop()
+                    try:
+                        transfer.curl.reset()
+                        self._setup_transfer(transfer, self._choose_server())
+                        multi.add_handle(transfer.curl)
+                    except Exception:
+                        log.error('Error setting up pycurl transfer', exc_info=1)
+                        free.append(transfer)
+                        setup_failed = True
+                        break
+
+                    active[transfer.curl] = transfer
+
+                while True:
+                    ret, _ = multi.perform()
+                    if ret != pycurl.E_CALL_MULTI_PERFORM:
+                        break
+
+                while True:
+                    queued, ok_list, err_list = multi.info_read()
+                    for c in ok_list:
+                        self._finish_transfer(multi, active, free, c, self._transfer_done)
+
+                    for c, errno, errmsg in err_list:
+                        self._finish_transfer(multi, active, free, c, self._transfer_error,
+                                              '({}, {})'.format(errno, errmsg))
+
+                    if not queued:
+                        break
+
+                if active:
+                    multi.select(0.1)
+                elif setup_failed:
+                    time.sleep(0.1)     # do not spin on a setup that keeps failing.
+
+        except Exception:
+            log.error('pycurl engine stopped', exc_info=1)
+        finally:
+            self._engine_running = False
+            for c, transfer in active.items():
+                try:
+                    multi.remove_handle(c)
+                except pycurl.error:
+                    pass
+
+                free.append(transfer)
+
+            for transfer in free:
+                transfer.curl.close()
+
+            multi.close()
+
+    def _finish_transfer(self, multi, active, free, c, handler, *args):
+        '''Take a finished transfer off the multi handle, hand it to handler and free it.'''
+        multi.remove_handle(c)
+        transfer = active.pop(c)
+        try:
+            handler(transfer, *args)
+        except Exception:
+            log.error('Error handling finished pycurl transfer', exc_info=1)
+        finally:
+            free.append(transfer)
+
+    def oneClient(self):
+        """ 
+            Called when the next client should fire (after interval time) 
+            We "overload" it here so we can write the results to our collection 
+            as the base class does not give us access to the command output.
+        """
+        if not self._db_configured:
+            self._configure_database()
+
+        if len(self.servers) < 1:
+            log.warning("no servers to contact, nothing to do")
+            return
+
+        if self.concurrency > 0:
+            if not self._engine_running:
+                self._start_engine()
+
+            if not self.saturate:
+                try:
+                    self._pending.put_nowait(True)
+                except Queue.Full:
+                    log.warning('{} transfers already waiting, not starting another.'.format(
+                        self.concurrency))
+            return
+
+        dst = self._choose_server()
+        transfer = self._checkout_transfer(dst)
+        self._setup_transfer(transfer, dst)
+        try:
+            transfer.curl.perform()
+        except pycurl.error as e:
+            self._transfer_error(transfer, e)
+            transfer.curl.close()
+            return
+
+        self._transfer_done(transfer)
+        self._checkin_transfer(transfer)
+
+    @agentmethod()
+    def startClient(self, msg):
+        if not self.open_loop:
+            return TrafficClientAgent.startClient(self, msg)
+
+        # do this here, not lazily in oneClient, as the workers call oneClient concurrently.
+        if not self._db_configured:
+            self._configure_database()
+
+        if self.concurrency > 0 and not self._engine_running:
+            self._start_engine()
+
+        self._size_sampler()
+        self._scheduler = OpenLoopScheduler(self.oneClient, DistributionSampler(self.interval),
+                                            workers=int(self.workers),
+                                            report=self._collection_schedule.insert,
+                                            abort=self._abort_transfers)
+        self._scheduler.start()
+        return True
+
+    @agentmethod()
+    def stopClient(self, msg):
+        if self._scheduler:
+            self._scheduler.stop()
+            self._scheduler = None
+            ret = True
+        else:
+            ret = TrafficClientAgent.stopClient(self, msg)
+
+        self._stop_engine()
+        self._aborting = False
+        self._close_idle()
+        if self._histograms:
+            self._histograms.publish(self._latency_sink.add)
+
+        for sink in [self._sink, self._error_sink, self._progress_sink, self._latency_sink]:
+            if sink:
+                sink.flush()
+
+        return ret
+
+    def _abort_transfers(self):
+        # the progress callback sees this and aborts, so workers do not wait out a long download.
+        self._aborting = True
+
+    def _size_sampler(self):
+        # rebuild the sampler only when the sizes expression is (re)configured.
+        with self._sizes_lock:
+            if not self._sizes or self._sizes.expression != str(self.sizes):
+                self._sizes = DistributionSampler(self.sizes)
 
-        c.close()
+            return self._sizes
 
     def increaseTraffic(self, msg, stepsize):
-        self.sizes = int(eval(self.sizes)) + stepsize
-        self.sizes = str(self.sizes)
+        self._size_sampler().adjust(stepsize)
 
     def reduceTraffic(self, msg, stepsize):
-        self.sizes = int(eval(self.sizes)) - stepsize
-        if(self.sizes < 0):
-            self.sizes = 0
-        self.sizes = str(self.sizes)
+        self._size_sampler().adjust(-stepsize)
                
     def changeTraffic(self, msg, stepsize):
         prob = random.randint(0, 100)
         if prob in range(10):
-            self.sizes = int(eval(self.sizes)) + int(stepsize * random.random())
+            self._size_sampler().adjust(int(stepsize * random.random()))
         elif prob in range(10, 20):
-            self.sizes = int(eval(self.sizes)) - int(stepsize * random.random())
-            if(self.sizes < 0):
-                self.sizes = 0
-        self.sizes = str(self.sizes)
+            self._size_sampler().adjust(-int(stepsize * random.random()))
 
     def confirmConfiguration(self):
         try: 
@@ -221,6 +531,20 @@ class PyCurlAgent(TrafficClientAgent):
         if self.socksVersion not in [4, 5]:
             return False
 
+        try:
+            self.concurrency = int(self.concurrency)
+        except ValueError:
+            log.error('incorrect type for concurrency ("{}"). Must be int.'.format(
+                self.concurrency))
+            return False
+
+        try:
+            self.max_host_connections = int(self.max_host_connections)
+        except ValueError:
+            log.error('incorrect type for max_host_connections ("{}"). Must be int.'.format(
+                self.max_host_connections))
+            return False
+
         return True
     
 def getAgent(**kwargs):
@@ -8,7 +8,7 @@ from magi.util.agent import agentmethod, DispatchAgent
 from magi.util.processAgent import initializeProcessAgent
 from magi.testbed import testbed
 
-from subprocess import Popen, STDOUT, CalledProcessError, check_call
+from process_supervisor import ProcessSupervisor, exit_trigger
 
 import logging
 
@@ -20,48 +20,35 @@ class RunProcAgent(DispatchAgent):
     '''
     def __init__(self):
         DispatchAgent.__init__(self)
-        self.proc = None
         self.logfile = None
-        self._lfd = None    # log file descriptor
+        self.restart = 'never'      # restart policy: never, on-failure or always.
+        self.stop_timeout = 5.0     # seconds to wait after SIGINT before killing the process.
+        self._supervisor = ProcessSupervisor(exit_trigger(self, testbed.nodename))
         
     @agentmethod()
     def run(self, msg, cmd, logfile, blocking):
         log.info('running: {} > {}'.format(cmd, logfile))
 
         # stop possibly running process. 
-        self.stop()
-    
-        try:
-            self._lfd = open(self.logfile, 'w')
-        except IOError as e:
-            log.critical('Unable to open logfile for writing, {}'.format(logfile))
-            return False
+        self.stop(msg)
 
-        try:
-            if blocking:
-                ret = call(cmd.split(), close_fds=True, stdout=self._lfd, stderr=STDOUT, shell=False)
-            else:
-                self.proc = Popen(cmd.split(), close_fds=True, stdout=self._lfd, stderr=STDOUT, shell=False)
-        except CalledProcessError as e:
-            log.critical('error running cmd: {}'.format(e))
+        self.logfile = logfile if logfile else self.logfile
+        if not self._supervisor.start('proc', cmd, logfile=self.logfile, restart=self.restart):
+            log.critical('error running cmd: {}'.format(cmd))
             return False
 
+        if blocking:
+            self._supervisor.wait('proc')
+
         return True
     
     @agentmethod()
     def stop(self, msg):
-        if self.proc:
-            log.info('killing running process')
-            self.proc.kill()
-        
-        self._close_log()
-    
-    def _close_log(self):
-        if self._lfd:
-            log.info('closing logfile {}'.format(self.logfile))
-            self._lfd.close()
-            self._lfd = None
-            self.logfile = None
+        if self._supervisor.names():
+            log.info('stopping running process')
+            self._supervisor.stop_all(timeout=float(self.stop_timeout))
+
+        return True
 
 def getAgent(**kwargs):
     agent = RunProcAgent()